@@ -0,0 +1,117 @@
+"""
+Micro-benchmark of the per-node cost of collecting the fields requested by a
+query (``get_loaded_columns``, called by ``load_node`` for every node), with
+and without the per-request memoization of ``get_fields``:
+
+    python bin/benchmark_get_fields.py --rows 10000
+
+No database is needed: the fields are collected from a parsed query.
+"""
+
+import argparse
+import timeit
+from types import SimpleNamespace
+
+import flask
+from graphql.language import ast
+from graphql.language.parser import parse
+from psqlgraph import Node
+
+from peregrine.api import app, dictionary_init
+from peregrine.resources.submission.graphql import node, util
+
+QUERY = """
+fragment caseFields on case {
+  submitter_id
+  project_id
+  samples { id sample_type aliquots { id concentration } }
+}
+query Test {
+  case (first: 0) {
+    id
+    ...caseFields
+    demographics { gender race ethnicity }
+    diagnoses { primary_diagnosis age_at_diagnosis }
+  }
+}
+"""
+
+
+def make_info(query):
+    """Return the parts of a ResolveInfo used by ``get_fields`` for the
+    first root field of the query"""
+    document = parse(query)
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, ast.FragmentDefinition)
+    }
+    operation = next(
+        definition
+        for definition in document.definitions
+        if isinstance(definition, ast.OperationDefinition)
+    )
+    field = operation.selection_set.selections[0]
+    return SimpleNamespace(field_asts=[field], fragments=fragments)
+
+
+def benchmark_get_fields(rows, repeat):
+    dictionary_init(app)
+    entity = Node.get_subclass("case")
+    info = make_info(QUERY)
+    depend_on = node.Node.fields_depend_on_columns
+
+    def uncached():
+        flask.g.pop("collected_fields", None)
+        util.get_loaded_columns(entity, info, depend_on)
+
+    def cached():
+        util.get_loaded_columns(entity, info, depend_on)
+
+    results = {}
+    with app.app_context():
+        for name, row in [("before", uncached), ("after", cached)]:
+            best = min(timeit.repeat(row, number=rows, repeat=repeat))
+            results[name] = best / rows
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows",
+        type=int,
+        action="store",
+        default=10000,
+        help="number of nodes loaded per run",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        action="store",
+        default=5,
+        help="number of runs (the best one is reported)",
+    )
+    parser.add_argument(
+        "--dictionary-url",
+        type=str,
+        action="store",
+        help="URL of the dictionary (default: gdcdictionary)",
+    )
+    parser.add_argument(
+        "--path-to-schema-dir",
+        type=str,
+        action="store",
+        help="local directory of the dictionary (instead of a URL)",
+    )
+    args = parser.parse_args()
+
+    if args.dictionary_url:
+        app.config["DICTIONARY_URL"] = args.dictionary_url
+    elif args.path_to_schema_dir:
+        app.config["PATH_TO_SCHEMA_DIR"] = args.path_to_schema_dir
+
+    results = benchmark_get_fields(args.rows, args.repeat)
+    for name, seconds in results.items():
+        print("{}: {:.2f} us per node".format(name, seconds * 1e6))
+    print("speedup: {:.1f}x".format(results["before"] / results["after"]))
@@ -0,0 +1,96 @@
+"""
+Create the trigram indexes used by the ``quick_search`` filter on every node
+table (see ``peregrine/resources/submission/graphql/quicksearch.py``):
+
+    python bin/create_quicksearch_indexes.py
+
+The ``pg_trgm`` extension is created if needed, which requires the privilege
+to create it. The indexes are built without locking the tables against
+writes, unless ``--no-concurrently`` is set. An index whose build failed is
+left invalid: drop the indexes with ``--drop`` and create them again. Run
+this command again after new node types are added to the dictionary.
+"""
+
+import argparse
+
+from psqlgraph import PsqlGraphDriver
+
+from peregrine.api import app, dictionary_init
+from peregrine.resources.submission.graphql import quicksearch
+
+
+def create_quicksearch_indexes(
+    host, user, password, database, concurrently=True, drop=False
+):
+    dictionary_init(app)
+    db = PsqlGraphDriver(host=host, user=user, password=password, database=database)
+    if drop:
+        quicksearch.drop_indexes(db.engine)
+        print("quick_search indexes dropped")
+        return
+    indexes = quicksearch.create_indexes(db.engine, concurrently=concurrently)
+    print("{} quick_search indexes created".format(len(indexes)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", type=str, action="store", default="localhost", help="psql-server host"
+    )
+    parser.add_argument(
+        "--user", type=str, action="store", default="test", help="psql test user"
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        action="store",
+        default="test",
+        help="psql test password",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        action="store",
+        default="peregrine_automated_test",
+        help="psql test database",
+    )
+    parser.add_argument(
+        "--no-concurrently",
+        dest="concurrently",
+        action="store_false",
+        default=True,
+        help="build the indexes faster, locking the tables against writes",
+    )
+    parser.add_argument(
+        "--drop",
+        action="store_true",
+        default=False,
+        help="drop the indexes instead of creating them",
+    )
+    parser.add_argument(
+        "--dictionary-url",
+        type=str,
+        action="store",
+        help="URL of the dictionary (default: gdcdictionary)",
+    )
+    parser.add_argument(
+        "--path-to-schema-dir",
+        type=str,
+        action="store",
+        help="local directory of the dictionary (instead of a URL)",
+    )
+    args = parser.parse_args()
+
+    if args.dictionary_url:
+        app.config["DICTIONARY_URL"] = args.dictionary_url
+    elif args.path_to_schema_dir:
+        app.config["PATH_TO_SCHEMA_DIR"] = args.path_to_schema_dir
+
+    create_quicksearch_indexes(
+        args.host,
+        args.user,
+        args.password,
+        args.database,
+        concurrently=args.concurrently,
+        drop=args.drop,
+    )
@@ -0,0 +1,54 @@
+"""
+Generate the graphql schema file (result of the introspection query) for a
+dictionary ahead of time. Point the ``PREBUILT_SCHEMA_DIR`` setting to the
+output directory so that peregrine loads it at startup instead of running
+the introspection query.
+
+The file is named after the dictionary (and its settings) and peregrine
+versions, so a directory can hold the files for several dictionaries.
+"""
+
+import argparse
+import os
+
+from peregrine.api import app, dictionary_init
+from peregrine.resources import submission
+
+
+def generate_schema(output_dir):
+    dictionary_init(app)
+    graphql_schema = submission.graphql.get_schema()
+    schema_file = os.path.join(output_dir, submission.get_schema_file_name())
+    submission.write_schema_file(graphql_schema, schema_file)
+    return schema_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        action="store",
+        default=".",
+        help="directory to write the schema file to",
+    )
+    parser.add_argument(
+        "--dictionary-url",
+        type=str,
+        action="store",
+        help="URL of the dictionary (default: gdcdictionary)",
+    )
+    parser.add_argument(
+        "--path-to-schema-dir",
+        type=str,
+        action="store",
+        help="local directory of the dictionary (instead of a URL)",
+    )
+    args = parser.parse_args()
+
+    if args.dictionary_url:
+        app.config["DICTIONARY_URL"] = args.dictionary_url
+    elif args.path_to_schema_dir:
+        app.config["PATH_TO_SCHEMA_DIR"] = args.path_to_schema_dir
+
+    print(generate_schema(args.output_dir))
@@ -0,0 +1,72 @@
+"""
+Generate the graph traversals file (all the paths between node types, used by
+``with_path_to`` filters) for a dictionary ahead of time. Point the
+``TRAVERSALS_DIR`` setting to the output directory so that peregrine loads
+it at startup instead of discovering the paths.
+
+The file is named after the dictionary and the traversal rules, so a
+directory can hold the files for several dictionaries. Pass the same
+``--max-path-length`` and ``--shortest-k`` as the ``TRAVERSAL_MAX_PATH_LENGTH``
+and ``TRAVERSAL_SHORTEST_K`` settings of the service for it to find the file.
+"""
+
+import argparse
+import os
+
+from peregrine.api import app, dictionary_init
+from peregrine.resources.submission.graphql import traversal
+
+
+def generate_traversals(output_dir):
+    dictionary_init(app)
+    app.graph_traversals = {}
+    traversal.make_graph_traversal_dict(app, preload=True)
+    traversals_file = os.path.join(output_dir, traversal.get_traversals_file_name(app))
+    traversal.save_graph_traversals(app.graph_traversals, traversals_file)
+    return traversals_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        action="store",
+        default=".",
+        help="directory to write the traversals file to",
+    )
+    parser.add_argument(
+        "--dictionary-url",
+        type=str,
+        action="store",
+        help="URL of the dictionary (default: gdcdictionary)",
+    )
+    parser.add_argument(
+        "--path-to-schema-dir",
+        type=str,
+        action="store",
+        help="local directory of the dictionary (instead of a URL)",
+    )
+    parser.add_argument(
+        "--max-path-length",
+        type=int,
+        action="store",
+        help="maximum number of links in a path (TRAVERSAL_MAX_PATH_LENGTH)",
+    )
+    parser.add_argument(
+        "--shortest-k",
+        type=int,
+        action="store",
+        help="number of shortest paths kept between two node types "
+        "(TRAVERSAL_SHORTEST_K)",
+    )
+    args = parser.parse_args()
+
+    if args.dictionary_url:
+        app.config["DICTIONARY_URL"] = args.dictionary_url
+    elif args.path_to_schema_dir:
+        app.config["PATH_TO_SCHEMA_DIR"] = args.path_to_schema_dir
+    app.config["TRAVERSAL_MAX_PATH_LENGTH"] = args.max_path_length
+    app.config["TRAVERSAL_SHORTEST_K"] = args.shortest_k
+
+    print(generate_traversals(args.output_dir))
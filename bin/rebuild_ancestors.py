@@ -0,0 +1,79 @@
+"""
+Rebuild the materialized ancestor mappings used by ``with_path_to`` filters,
+e.g. to map each file to its cases:
+
+    python bin/rebuild_ancestors.py --pair submitted_unaligned_reads:case
+
+Peregrine uses the mappings when the ``ANCESTOR_MAPPINGS`` setting is set.
+Writes to the edge tables along the paths mark the mappings as stale, so that
+peregrine falls back to traversing the graph until the next rebuild.
+"""
+
+import argparse
+
+from psqlgraph import PsqlGraphDriver
+
+from peregrine.api import app, dictionary_init
+from peregrine.resources.submission.graphql import ancestors
+
+
+def rebuild_ancestors(host, user, password, database, pairs):
+    dictionary_init(app)
+    app.graph_traversals = {}
+    db = PsqlGraphDriver(host=host, user=user, password=password, database=database)
+    ancestors.create_tables(db.engine)
+    for src_label, dst_label in pairs:
+        count = ancestors.rebuild(db, src_label, dst_label, app)
+        print("{} -> {}: {} rows".format(src_label, dst_label, count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", type=str, action="store", default="localhost", help="psql-server host"
+    )
+    parser.add_argument(
+        "--user", type=str, action="store", default="test", help="psql test user"
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        action="store",
+        default="test",
+        help="psql test password",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        action="store",
+        default="peregrine_automated_test",
+        help="psql test database",
+    )
+    parser.add_argument(
+        "--pair",
+        type=str,
+        action="append",
+        required=True,
+        help="<node type>:<ancestor type> mapping to rebuild (repeatable)",
+    )
+    parser.add_argument(
+        "--dictionary-url",
+        type=str,
+        action="store",
+        help="URL of the dictionary (default: gdcdictionary)",
+    )
+    parser.add_argument(
+        "--path-to-schema-dir",
+        type=str,
+        action="store",
+        help="local directory of the dictionary (instead of a URL)",
+    )
+    args = parser.parse_args()
+
+    if args.dictionary_url:
+        app.config["DICTIONARY_URL"] = args.dictionary_url
+    elif args.path_to_schema_dir:
+        app.config["PATH_TO_SCHEMA_DIR"] = args.path_to_schema_dir
+
+    pairs = [pair.split(":") for pair in args.pair]
+    rebuild_ancestors(args.host, args.user, args.password, args.database, pairs)
@@ -0,0 +1,69 @@
+"""
+Rebuild the global node index used by the queries of nodes by id or
+submitter id (``node(id: ...)``, ``node(submitter_id: ...)``, ``_links``):
+
+    python bin/rebuild_node_index.py
+
+Peregrine uses the index when the ``NODE_INDEX`` setting is set. The command
+also installs triggers on the node tables keeping the index up to date, so
+it only needs to run again after the tables of the dictionary change.
+"""
+
+import argparse
+
+from psqlgraph import PsqlGraphDriver
+
+from peregrine.api import app, dictionary_init
+from peregrine.resources.submission.graphql import node_index
+
+
+def rebuild_node_index(host, user, password, database):
+    dictionary_init(app)
+    db = PsqlGraphDriver(host=host, user=user, password=password, database=database)
+    node_index.create_tables(db.engine)
+    count = node_index.rebuild(db)
+    print("{} nodes indexed".format(count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", type=str, action="store", default="localhost", help="psql-server host"
+    )
+    parser.add_argument(
+        "--user", type=str, action="store", default="test", help="psql test user"
+    )
+    parser.add_argument(
+        "--password",
+        type=str,
+        action="store",
+        default="test",
+        help="psql test password",
+    )
+    parser.add_argument(
+        "--database",
+        type=str,
+        action="store",
+        default="peregrine_automated_test",
+        help="psql test database",
+    )
+    parser.add_argument(
+        "--dictionary-url",
+        type=str,
+        action="store",
+        help="URL of the dictionary (default: gdcdictionary)",
+    )
+    parser.add_argument(
+        "--path-to-schema-dir",
+        type=str,
+        action="store",
+        help="local directory of the dictionary (instead of a URL)",
+    )
+    args = parser.parse_args()
+
+    if args.dictionary_url:
+        app.config["DICTIONARY_URL"] = args.dictionary_url
+    elif args.path_to_schema_dir:
+        app.config["PATH_TO_SCHEMA_DIR"] = args.path_to_schema_dir
+
+    rebuild_node_index(args.host, args.user, args.password, args.database)
@@ -64,6 +64,75 @@ config["DICTIONARY_URL"] = environ.get(
     "https://s3.amazonaws.com/dictionary-artifacts/datadictionary/develop/schema.json",
 )
 
+# directory where the dictionary fetched from DICTIONARY_URL is saved for the
+# next start. The URL is fetched again when the saved copy is older than DICTIONARY_CACHE_MAX_AGE
+# seconds, or if the directory is not set
+config["DICTIONARY_CACHE_DIR"] = environ.get("DICTIONARY_CACHE_DIR")
+config["DICTIONARY_CACHE_MAX_AGE"] = int(environ.get("DICTIONARY_CACHE_MAX_AGE", 3600))
+
+# cache each user's list of readable projects for AUTHZ_CACHE_TTL seconds
+# (0: disabled). Set AUTHZ_CACHE_DIR to share the cache between workers.
+config["AUTHZ_CACHE"] = {
+    "TTL": int(environ.get("AUTHZ_CACHE_TTL", 0)),
+    "DIR": environ.get("AUTHZ_CACHE_DIR"),
+}
+
+# directory of schema files generated by bin/generate_schema.py
+config["PREBUILT_SCHEMA_DIR"] = environ.get("PREBUILT_SCHEMA_DIR")
+
+# directory of graph traversal files generated by bin/generate_traversals.py
+# (generated at startup and saved there if missing)
+config["TRAVERSALS_DIR"] = environ.get("TRAVERSALS_DIR")
+
+# limit the graph traversals used by the with_path_to filters to the paths of
+# at most TRAVERSAL_MAX_PATH_LENGTH links, and to the TRAVERSAL_SHORTEST_K
+# shortest paths between two node types (default: all the paths)
+config["TRAVERSAL_MAX_PATH_LENGTH"] = (
+    int(environ["TRAVERSAL_MAX_PATH_LENGTH"])
+    if environ.get("TRAVERSAL_MAX_PATH_LENGTH")
+    else None
+)
+config["TRAVERSAL_SHORTEST_K"] = (
+    int(environ["TRAVERSAL_SHORTEST_K"])
+    if environ.get("TRAVERSAL_SHORTEST_K")
+    else None
+)
+
+# "exists" evaluates the with_path_to filters as correlated EXISTS predicates,
+# which lets limited queries stop early (default: IN subqueries and set operations)
+config["WITH_PATH_TO_MODE"] = environ.get("WITH_PATH_TO_MODE", "in")
+
+# use the ancestor mappings built by bin/rebuild_ancestors.py in with_path_to
+# filters. A mapping is not maintained incrementally: any write to the edge
+# tables along its paths (e.g. a submission) makes it stale, and the filters
+# traverse the graph until bin/rebuild_ancestors.py is run again
+if environ.get("ANCESTOR_MAPPINGS", "").lower() == "true":
+    config["ANCESTOR_MAPPINGS"] = {
+        "REFRESH_INTERVAL": int(environ.get("ANCESTOR_MAPPINGS_REFRESH_INTERVAL", 60)),
+    }
+
+# look up the tables of the nodes queried by id or submitter_id in the node
+# index built by bin/rebuild_node_index.py
+if environ.get("NODE_INDEX", "").lower() == "true":
+    config["NODE_INDEX"] = {
+        "REFRESH_INTERVAL": int(environ.get("NODE_INDEX_REFRESH_INTERVAL", 60)),
+    }
+
+# cache GraphQL results for GRAPHQL_RESULT_CACHE_TTL seconds (0: disabled),
+# per set of readable projects. GRAPHQL_RESULT_CACHE_DIR shares it between workers
+config["GRAPHQL_RESULT_CACHE"] = {
+    "TTL": int(environ.get("GRAPHQL_RESULT_CACHE_TTL", 0)),
+    "MAX_SIZE": int(environ.get("GRAPHQL_RESULT_CACHE_MAX_SIZE", 1024)),
+    "DIR": environ.get("GRAPHQL_RESULT_CACHE_DIR"),
+}
+
+# reload the in-memory program/project catalog every N seconds. Changes made by
+# other services (e.g. sheepdog) are only seen on reload, so this is how long
+# peregrine may serve an out-of-date program/project list
+config["PROJECT_CATALOG"] = {
+    "REFRESH_INTERVAL": int(environ.get("PROJECT_CATALOG_REFRESH_INTERVAL", 60)),
+}
+
 hostname = environ.get("CONF_HOSTNAME") or conf_data["hostname"]
 config["OIDC_ISSUER"] = "https://%s/user" % hostname
 
@@ -1,3 +1,5 @@
+import contextlib
+import json
 import os
 import sys
 import time
@@ -10,7 +12,7 @@ from psqlgraph import PsqlGraphDriver
 
 from authutils import AuthError
 import datamodelutils
-from dictionaryutils import DataDictionary, dictionary as dict_init
+from dictionaryutils import dictionary as dict_init
 from cdispyutils.log import get_handler
 from cdispyutils.uwsgi import setup_user_harakiri
 from gen3authz.client.arborist.client import ArboristClient
@@ -18,14 +20,19 @@ from gen3authz.client.arborist.client import ArboristClient
 import peregrine
 from peregrine import dictionary
 from peregrine.blueprints import datasets, coremetadata
+from peregrine.catalog import ProjectCatalog, DEFAULT_REFRESH_INTERVAL
+from peregrine.utils import MemoryCache
+from peregrine.utils.pyutils import StartupProfile
 from .errors import APIError, setup_default_handlers, UnhealthyCheck
 from .resources import submission
+from .resources.submission.graphql import ancestors, node_index
 from .version_data import VERSION, COMMIT
 
 
 # recursion depth is increased for complex graph traversals
 sys.setrecursionlimit(10000)
 DEFAULT_ASYNC_WORKERS = 8
+DEFAULT_GRAPHQL_DOCUMENT_CACHE_SIZE = 1000
 
 
 def app_register_blueprints(app):
@@ -64,6 +71,87 @@ def async_pool_init(app):
     app.async_pool.start(n_async_workers)
 
 
+def authz_cache_init(app):
+    """
+    Create the cache of the users' read access projects. It is disabled
+    unless ``AUTHZ_CACHE["TTL"]`` is set.
+    """
+    config = app.config.get("AUTHZ_CACHE", {})
+    if config.get("TTL"):
+        app.authz_cache = peregrine.utils.cache.make_cache(config)
+    else:
+        app.authz_cache = None
+
+
+def project_catalog_init(app):
+    """Create the catalog of programs and projects and load it."""
+    refresh_interval = app.config.get("PROJECT_CATALOG", {}).get(
+        "REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL
+    )
+    app.project_catalog = ProjectCatalog(app.db, refresh_interval=refresh_interval)
+    try:
+        app.project_catalog.load()
+    except Exception as e:
+        # e.g. the tables do not exist yet: load it on first use instead
+        app.logger.warning("Unable to load the project catalog: {}".format(e))
+
+
+def ancestor_mappings_init(app):
+    """Use the materialized ancestor mappings if ANCESTOR_MAPPINGS is set."""
+    app.ancestor_mappings = None
+    config = app.config.get("ANCESTOR_MAPPINGS")
+    if config is None:
+        return
+    app.ancestor_mappings = ancestors.AncestorMappings(
+        app.db,
+        refresh_interval=config.get(
+            "REFRESH_INTERVAL", ancestors.DEFAULT_REFRESH_INTERVAL
+        ),
+    )
+
+
+def node_index_init(app):
+    """Use the global node index if NODE_INDEX is set."""
+    app.node_index = None
+    config = app.config.get("NODE_INDEX")
+    if config is None:
+        return
+    app.node_index = node_index.NodeIndex(
+        app.db,
+        refresh_interval=config.get(
+            "REFRESH_INTERVAL", node_index.DEFAULT_REFRESH_INTERVAL
+        ),
+    )
+
+
+def graphql_backend_init(app):
+    """
+    Create the GraphQL backend, which caches up to
+    ``GRAPHQL_DOCUMENT_CACHE["MAX_SIZE"]`` parsed and validated queries.
+    """
+    max_size = app.config.get("GRAPHQL_DOCUMENT_CACHE", {}).get(
+        "MAX_SIZE", DEFAULT_GRAPHQL_DOCUMENT_CACHE_SIZE
+    )
+    if max_size:
+        app.graphql_backend = submission.graphql.CachedDocumentBackend(
+            MemoryCache(max_size=max_size)
+        )
+    else:
+        app.graphql_backend = None
+
+
+def graphql_result_cache_init(app):
+    """
+    Create the cache of the GraphQL query results. It is disabled unless
+    ``GRAPHQL_RESULT_CACHE["TTL"]`` is set.
+    """
+    config = app.config.get("GRAPHQL_RESULT_CACHE", {})
+    if config.get("TTL"):
+        app.graphql_result_cache = peregrine.utils.cache.make_cache(config)
+    else:
+        app.graphql_result_cache = None
+
+
 def db_init(app):
     app.logger.info("Initializing PsqlGraph driver")
     app.db = PsqlGraphDriver(
@@ -91,11 +179,17 @@ def dictionary_init(app):
     if "DICTIONARY_URL" in app.config:
         url = app.config["DICTIONARY_URL"]
         app.logger.info(f"Initializing dictionary from url '{url}'")
-        d = DataDictionary(url=url)
+        d = dictionary.load_from_url(
+            url,
+            app.config.get("DICTIONARY_CACHE_DIR"),
+            app.config.get("DICTIONARY_CACHE_MAX_AGE"),
+        )
         dict_init.init(d)
     elif "PATH_TO_SCHEMA_DIR" in app.config:
         app.logger.info("Initializing dictionary from schema dir")
-        d = DataDictionary(root_dir=app.config["PATH_TO_SCHEMA_DIR"])
+        d = dictionary.load_from_dir(
+            app.config["PATH_TO_SCHEMA_DIR"], app.config.get("DICTIONARY_CACHE_DIR")
+        )
         dict_init.init(d)
     else:
         app.logger.info("Initializing dictionary from gdcdictionary")
@@ -103,8 +197,9 @@ def dictionary_init(app):
 
         d = gdcdictionary.gdcdictionary
     dictionary.init(d)
-    from gen3datamodel import models as md
-    from gen3datamodel import validators as vd
+    with startup_phase(app, "import gen3datamodel"):
+        from gen3datamodel import models as md
+        from gen3datamodel import validators as vd
 
     datamodelutils.validators.init(vd)
     datamodelutils.models.init(md)
@@ -113,37 +208,78 @@ def dictionary_init(app):
     app.logger.info("Initialized dictionary in {} sec".format(end))
 
 
+def startup_phase(app, name):
+    """Time a phase of ``app_init`` in ``app.startup_profile``, if any."""
+    profile = getattr(app, "startup_profile", None)
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.phase(name)
+
+
 def app_init(app):
     app.logger.setLevel(logging.INFO)
+    app.startup_profile = StartupProfile()
 
     # Register duplicates only at runtime
     app.logger.info("Initializing app")
-    dictionary_init(app)
+    with startup_phase(app, "dictionary_init"):
+        dictionary_init(app)
 
     if app.config.get("USE_USER_HARAKIRI", True):
-        setup_user_harakiri(app)
-
-    app_register_blueprints(app)
-    app_register_duplicate_blueprints(app)
-
-    db_init(app)
+        with startup_phase(app, "setup_user_harakiri"):
+            setup_user_harakiri(app)
+
+    with startup_phase(app, "register_blueprints"):
+        app_register_blueprints(app)
+        app_register_duplicate_blueprints(app)
+
+    with startup_phase(app, "db_init"):
+        db_init(app)
+    with startup_phase(app, "project_catalog_init"):
+        project_catalog_init(app)
+    with startup_phase(app, "ancestor_mappings_init"):
+        ancestor_mappings_init(app)
+    with startup_phase(app, "node_index_init"):
+        node_index_init(app)
     # exclude es init as it's not used yet
     # es_init(app)
-    cors_init(app)
-    submission.graphql.make_graph_traversal_dict(app)
-    app.graphql_schema = submission.graphql.get_schema()
-    app.schema_file = submission.generate_schema_file(app.graphql_schema, app.logger)
-    async_pool_init(app)
+    with startup_phase(app, "cors_init"):
+        cors_init(app)
+    with startup_phase(app, "make_graph_traversal_dict"):
+        submission.graphql.make_graph_traversal_dict(app)
+    with startup_phase(app, "get_schema"):
+        app.graphql_schema = submission.graphql.get_schema()
+    with startup_phase(app, "graphql_backend_init"):
+        graphql_backend_init(app)
+    with startup_phase(app, "graphql_result_cache_init"):
+        graphql_result_cache_init(app)
+    with startup_phase(app, "generate_schema_file"):
+        app.schema_file = submission.generate_schema_file(
+            app.graphql_schema, app.logger, app.config.get("PREBUILT_SCHEMA_DIR")
+        )
+        app.schema_etag = submission.get_file_etag(app.schema_file)
+    with startup_phase(app, "async_pool_init"):
+        async_pool_init(app)
+    with startup_phase(app, "authz_cache_init"):
+        authz_cache_init(app)
 
     # ARBORIST deprecated, replaced by ARBORIST_URL
-    arborist_url = os.environ.get("ARBORIST_URL", os.environ.get("ARBORIST"))
-    if arborist_url:
-        app.auth = ArboristClient(arborist_base_url=arborist_url)
-    else:
-        app.logger.info("Using default Arborist base URL")
-        app.auth = ArboristClient()
-
+    with startup_phase(app, "arborist_init"):
+        arborist_url = os.environ.get("ARBORIST_URL", os.environ.get("ARBORIST"))
+        if arborist_url:
+            app.auth = ArboristClient(arborist_base_url=arborist_url)
+        else:
+            app.logger.info("Using default Arborist base URL")
+            app.auth = ArboristClient()
+
+    app.startup_profile.finish(
+        dictionary_checksum=dictionary.checksum(),
+        graphql_types=len(app.graphql_schema.get_type_map()),
+    )
     app.logger.info("Initialization complete.")
+    app.logger.info(
+        "Startup profile: {}".format(json.dumps(app.startup_profile.to_dict()))
+    )
 
 
 app = Flask(__name__)
@@ -165,6 +301,28 @@ def health_check():
     return "Healthy", 200
 
 
+@app.route("/_status/startup", methods=["GET"])
+def startup_status():
+    """Report the duration of the startup phases (see ``app_init``)"""
+    return jsonify(app.startup_profile.to_dict()), 200
+
+
+@app.route("/_status/caches", methods=["GET"])
+def cache_status():
+    """Report the size, hits and misses of the caches of this process"""
+    caches = {
+        "graphql_documents": getattr(app.graphql_backend, "cache", None),
+        "graphql_results": app.graphql_result_cache,
+        "authz": app.authz_cache,
+    }
+    return (
+        jsonify(
+            {name: cache.stats() for name, cache in caches.items() if cache is not None}
+        ),
+        200,
+    )
+
+
 @app.route("/_version", methods=["GET"])
 def version():
     # dictver['commit'] deprecated; see peregrine#130
@@ -10,7 +10,6 @@ or
 
 from authutils.user import current_user
 from cdislogging import get_logger
-from datamodelutils import models
 from gen3authz.client.arborist.errors import ArboristError
 import flask
 
@@ -33,54 +32,50 @@ def resource_path_to_project_ids(resource_path):
         )
         return []
 
+    catalog = flask.current_app.project_catalog
+
     # "/" or "/programs": access to all programs
     if len(parts) == 1:
-        programs = flask.current_app.db.nodes(models.Program).all()
-        return [
-            program.name + "-" + project.code
-            for program in programs
-            for project in program.projects
-        ]
+        return catalog.project_ids()
 
     # "/programs/[...]" or "/programs/[...]/projects/":
     # access to all projects of a program
     if len(parts) < 4:
         program_name = parts[1]
-        program = (
-            flask.current_app.db.nodes(models.Program).props(name=program_name).first()
-        )
-        if not program:
+        if not catalog.has_program(program_name):
             logger.debug(
                 "program {} in resource path {} does not exist".format(
                     program_name, resource_path
                 )
             )
             return []
-        return [program.name + "-" + project.code for project in program.projects]
+        return catalog.program_project_ids(program_name)
 
     # "/programs/[...]/projects/[...]": access to a specific project
     # here, len(parts) == 4 and parts[2] == "projects"
     project_code = parts[3]
-    project = (
-        flask.current_app.db.nodes(models.Project).props(code=project_code).first()
-    )
-    if not project:
+    project_ids = catalog.code_project_ids(project_code)
+    if not project_ids:
         logger.debug(
             "project {} in resource path {} does not exist".format(
                 project_code, resource_path
             )
         )
-        return []
-    return [program.name + "-" + project.code for program in project.programs]
+    return project_ids
 
 
-def get_read_access_projects():
+def get_read_access_projects(raise_errors=False):
     """
     Get all resources the user has read access to and parses the Arborist resource paths into a program.name and a project.code.
+
+    If ``raise_errors`` is set, an ``ArboristError`` is raised instead of
+    returning an empty list when the auth mapping cannot be retrieved.
     """
     try:
         mapping = flask.current_app.auth.auth_mapping(current_user.username)
     except ArboristError as e:
+        if raise_errors:
+            raise
         # Arborist errored, or this user is unknown to Arborist
         logger.warn(
             "Unable to retrieve auth mapping for user `{}`: {}".format(
@@ -89,18 +84,17 @@ def get_read_access_projects():
         )
         mapping = {}
 
-    with flask.current_app.db.session_scope():
-        read_access_projects = [
-            project_id
-            for resource_path, permissions in mapping.items()
-            for project_id in resource_path_to_project_ids(resource_path)
-            # ignore resource if no peregrine read access:
-            if any(
-                permission.get("service") in ["*", "peregrine"]
-                and permission.get("method") in ["*", "read"]
-                for permission in permissions
-            )
-        ]
+    read_access_projects = [
+        project_id
+        for resource_path, permissions in mapping.items()
+        for project_id in resource_path_to_project_ids(resource_path)
+        # ignore resource if no peregrine read access:
+        if any(
+            permission.get("service") in ["*", "peregrine"]
+            and permission.get("method") in ["*", "read"]
+            for permission in permissions
+        )
+    ]
 
     # return unique project_ids
     return list(set(read_access_projects))
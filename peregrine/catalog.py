@@ -0,0 +1,171 @@
+"""
+In-memory catalog of the programs and projects, so that authorization and
+the public endpoints do not load the Program and Project nodes on every
+request.
+
+The catalog is reloaded (with a single query) when it is older than its
+refresh interval, or after a transaction in this process changes a program
+or a project. Programs and projects are written by other services (e.g.
+sheepdog), whose changes are only seen on the next reload: the refresh
+interval bounds how long the catalog can be out of date.
+"""
+
+from collections import namedtuple
+import threading
+import time
+import weakref
+
+from cdislogging import get_logger
+from datamodelutils import models
+import psqlgraph
+import sqlalchemy as sa
+
+from peregrine.resources.submission.graphql.node import get_link_edge
+
+logger = get_logger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+CatalogProject = namedtuple(
+    "CatalogProject", ["node_id", "code", "program", "availability_type", "state"]
+)
+
+# the catalogs invalidated by the transactions of this process (the session
+# listeners below are registered once for all of them)
+_catalogs = weakref.WeakSet()
+
+
+class ProjectCatalog(object):
+    def __init__(self, db, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        Args:
+            db (psqlgraph.PsqlGraphDriver): database driver
+            refresh_interval (float): seconds before the catalog is reloaded
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._index = None
+        _catalogs.add(self)
+
+    def invalidate(self):
+        """Reload the catalog on its next use"""
+        self._loaded_at = None
+
+    def load(self):
+        """
+        Load all the programs and their projects. A project belonging to
+        several programs appears once per program.
+        """
+        edge, project_id_column, program_id_column = get_link_edge(
+            models.Project, "programs"
+        )
+        with self.db.session_scope() as session:
+            rows = (
+                session.query(
+                    models.Program._props["name"].astext,
+                    models.Project.node_id,
+                    models.Project._props,
+                )
+                .outerjoin(edge, program_id_column == models.Program.node_id)
+                .outerjoin(models.Project, models.Project.node_id == project_id_column)
+                .all()
+            )
+
+        by_id = {}
+        by_program = {}
+        by_code = {}
+        for program, node_id, props in rows:
+            projects = by_program.setdefault(program, [])
+            if props is None:
+                continue  # program without projects
+            project = CatalogProject(
+                node_id=node_id,
+                code=props.get("code"),
+                program=program,
+                availability_type=props.get("availability_type"),
+                state=props.get("state"),
+            )
+            projects.append(project)
+            by_id["{}-{}".format(program, project.code)] = project
+            by_code.setdefault(project.code, []).append(project)
+
+        self._index = (by_id, by_program, by_code)
+        self._loaded_at = time.time()
+
+    def _get_index(self):
+        with self._lock:
+            if (
+                self._loaded_at is None
+                or time.time() - self._loaded_at > self.refresh_interval
+            ):
+                self.load()
+            return self._index
+
+    def project_ids(self):
+        """List the ids of all the projects"""
+        return list(self._get_index()[0])
+
+    def get(self, project_id):
+        """Return the ``CatalogProject`` for a project id, or None"""
+        return self._get_index()[0].get(project_id)
+
+    def has_program(self, program):
+        return program in self._get_index()[1]
+
+    def program_project_ids(self, program):
+        """List the ids of the projects of a program"""
+        return [
+            "{}-{}".format(program, project.code)
+            for project in self._get_index()[1].get(program, [])
+        ]
+
+    def code_project_ids(self, code):
+        """
+        List the ids of the first project with code ``code``: one id per
+        program the project belongs to.
+        """
+        projects = self._get_index()[2].get(code, [])
+        return [
+            "{}-{}".format(project.program, code)
+            for project in projects
+            if project.node_id == projects[0].node_id
+        ]
+
+    def open_project_ids(self):
+        """List the ids of the projects with ``availability_type == "Open"``"""
+        return [
+            project_id
+            for project_id, project in self._get_index()[0].items()
+            if project.availability_type == "Open"
+        ]
+
+    def active_project_ids(self):
+        """List the ids of the projects that are not closed or legacy"""
+        return [
+            project_id
+            for project_id, project in self._get_index()[0].items()
+            if project.state is not None and project.state not in ("closed", "legacy")
+        ]
+
+
+def _changes_catalog(obj):
+    if isinstance(obj, psqlgraph.Edge):
+        return obj.__src_class__ == "Project" and obj.__dst_class__ == "Program"
+    return isinstance(obj, (models.Program, models.Project))
+
+
+@sa.event.listens_for(sa.orm.Session, "after_flush")
+def _after_flush(session, flush_context):
+    changed = session.new | session.dirty | session.deleted
+    if any(_changes_catalog(obj) for obj in changed):
+        session.info["project_catalog_changed"] = True
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def _after_commit(session):
+    if session.info.pop("project_catalog_changed", False):
+        logger.debug("Programs or projects changed, invalidating the catalogs")
+        for catalog in list(_catalogs):
+            catalog.invalidate()
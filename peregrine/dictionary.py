@@ -9,7 +9,18 @@ the attributes of this module. For example, using
     peregrine.dictionary.init(gdcdictionary.gdcdictionary)
 """
 
+import glob
+import hashlib
+import json
+import os
 import sys
+import time
+
+from cdislogging import get_logger
+from dictionaryutils import DataDictionary, load_schemas_from_dir
+import requests
+
+logger = get_logger(__name__)
 
 
 # Get this module as a variable so its attributes can be set later.
@@ -24,6 +35,8 @@ resolvers = None
 schema = None
 settings = None
 
+_checksum = None
+
 
 def init(dictionary):
     """
@@ -51,3 +64,117 @@ def init(dictionary):
             setattr(this_module, optional_attr, getattr(dictionary, optional_attr))
         except AttributeError:
             pass
+
+    this_module._checksum = None
+
+
+def checksum():
+    """
+    Return a hash of the dictionary schema, which identifies the dictionary
+    version.
+
+    Return:
+        str: hex digest
+    """
+    if this_module._checksum is None:
+        this_module._checksum = get_schema_checksum(schema)
+    return this_module._checksum
+
+
+def get_schema_checksum(schema):
+    """Return the checksum of a dictionary schema, see :func:`checksum`"""
+    dump = json.dumps(schema, sort_keys=True, default=str)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+
+def load_from_dir(root_dir, cache_dir=None):
+    """
+    Load a ``DataDictionary`` from a directory of YAML schemas.
+
+    Parsing the YAML files takes most of the loading time. If ``cache_dir``
+    is set, the parsed schemas are saved there as a JSON bundle named after
+    a checksum of the files, and later loaded from it like a dictionary
+    published at a URL.
+
+    Return:
+        dictionaryutils.DataDictionary
+    """
+    if not cache_dir:
+        return DataDictionary(root_dir=root_dir)
+
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(root_dir, "*.yaml"))):
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    bundle = os.path.join(cache_dir, "dictionary-{}.json".format(digest.hexdigest()))
+
+    if not os.path.isfile(bundle):
+        schemas, _ = load_schemas_from_dir(root_dir)
+        try:
+            content = json.dumps(schemas)
+        except TypeError:
+            # e.g. YAML dates: the bundle would not load the same schemas
+            return DataDictionary(root_dir=root_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(bundle, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, bundle)
+
+    return DataDictionary(local_file=bundle)
+
+
+def load_from_url(url, cache_dir=None, max_age=None):
+    """
+    Load a ``DataDictionary`` published at a URL.
+
+    If ``cache_dir`` is set, the fetched JSON is saved there in a file named
+    after the dictionary checksum (see :func:`checksum`), with an index file
+    per URL pointing to it. The dictionary is then loaded from that file
+    without fetching the URL again, until the index is older than
+    ``max_age`` seconds (None: never), or if the URL cannot be fetched.
+
+    Return:
+        dictionaryutils.DataDictionary
+    """
+    if not cache_dir:
+        return DataDictionary(url=url)
+
+    url_digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    index = os.path.join(cache_dir, "url-{}.json".format(url_digest))
+    bundle = None
+    if os.path.isfile(index):
+        with open(index, "r") as f:
+            bundle = os.path.join(cache_dir, json.load(f)["file_name"])
+        if not os.path.isfile(bundle):
+            bundle = None
+        elif max_age is None or time.time() - os.path.getmtime(index) < max_age:
+            return DataDictionary(local_file=bundle)
+
+    try:
+        r = requests.get(url)
+        r.raise_for_status()
+    except Exception as e:
+        if bundle is None:
+            raise
+        logger.warning(
+            "Unable to fetch the dictionary from {}, using {}: {}".format(
+                url, bundle, e
+            )
+        )
+        return DataDictionary(local_file=bundle)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to temporary files first so the files are never read partially
+    tmp_path = os.path.join(cache_dir, "dictionary.{}.tmp".format(os.getpid()))
+    with open(tmp_path, "w") as f:
+        f.write(r.text)
+    d = DataDictionary(local_file=tmp_path)
+    file_name = "dictionary-{}.json".format(get_schema_checksum(d.schema))
+    os.replace(tmp_path, os.path.join(cache_dir, file_name))
+    tmp_path = "{}.{}.tmp".format(index, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"url": url, "file_name": file_name}, f)
+    os.replace(tmp_path, index)
+    return d
@@ -4,14 +4,20 @@ Construct the blueprint for peregrine submissions, using the blueprint from
 """
 
 import os
+import gzip
+import hashlib
 import json
 import time
 import fcntl
 
+from authutils.token.validate import current_token
+from authutils.user import current_user
 from cdiserrors import AuthZError
-import datamodelutils.models as models
 import flask
+from gen3authz.client.arborist.errors import ArboristError
 
+from peregrine import dictionary
+from peregrine.version_data import VERSION, COMMIT
 from peregrine.auth import get_read_access_projects
 import peregrine.blueprints
 from peregrine.resources.submission import graphql
@@ -27,20 +33,7 @@ def get_open_project_ids():
             list of project ids for open projects and list of error messages
             generated from running graphql
     """
-    if not hasattr(models.Project, "availability_type"):
-        return []
-
-    with flask.current_app.db.session_scope():
-        projects = (
-            flask.current_app.db.nodes(models.Project)
-            .filter(models.Project.availability_type.astext == "Open")
-            .all()
-        )
-        return [
-            program["name"] + "-" + project["code"]
-            for project in projects
-            for program in project["programs"]
-        ]
+    return flask.current_app.project_catalog.open_project_ids()
 
 
 def set_read_access_projects_for_public_endpoint():
@@ -49,13 +42,7 @@ def set_read_access_projects_for_public_endpoint():
     that doesn't need authorization
     """
 
-    with flask.current_app.db.session_scope():
-        projects = flask.current_app.db.nodes(models.Project).all()
-        flask.g.read_access_projects = [
-            program["name"] + "-" + project["code"]
-            for project in projects
-            for program in project["programs"]
-        ]
+    flask.g.read_access_projects = flask.current_app.project_catalog.project_ids()
 
 
 def set_read_access_projects():
@@ -79,9 +66,63 @@ def set_read_access_projects():
         ``flask.g.read_access_projects``.
     """
     if not hasattr(flask.g, "read_access_projects"):
-        flask.g.read_access_projects = list(
-            set(get_read_access_projects() + get_open_project_ids())
+        flask.g.read_access_projects = get_user_read_access_projects()
+
+
+def get_user_read_access_projects():
+    """
+    List the projects the current user has read access to (see
+    ``set_read_access_projects``).
+
+    If ``flask.current_app.authz_cache`` is enabled, the list is cached per
+    user until the cache TTL or the user's token expires, whichever comes
+    first. A new token invalidates the cached list. The list is not cached
+    if Arborist fails to return the user's auth mapping.
+
+    Return:
+        List[str]: project ids
+    """
+    cache = getattr(flask.current_app, "authz_cache", None)
+    if cache is None:
+        return list(set(get_read_access_projects() + get_open_project_ids()))
+
+    username = current_user.username
+    # the claims of the token validated for ``current_user``
+    token_exp = (current_token or {}).get("exp")
+    cached = cache.get(username)
+    if cached is not None and cached["exp"] == token_exp:
+        return cached["projects"]
+
+    try:
+        projects = get_read_access_projects(raise_errors=True)
+    except ArboristError as e:
+        # not cached: the next request asks Arborist again
+        flask.current_app.logger.warning(
+            "Unable to retrieve auth mapping for user `{}`: {}".format(username, e)
         )
+        return get_open_project_ids()
+    projects = list(set(projects + get_open_project_ids()))
+    ttl = cache.default_ttl
+    if token_exp is not None:
+        ttl = min(ttl, token_exp - time.time())
+    if ttl > 0:
+        cache.set(username, {"exp": token_exp, "projects": projects}, ttl=ttl)
+    return projects
+
+
+def invalidate_read_access_projects(username=None):
+    """
+    Remove the cached list of projects the user ``username`` has read access
+    to, or the lists of all the users if ``username`` is None. To be called
+    when permissions change.
+    """
+    cache = getattr(flask.current_app, "authz_cache", None)
+    if cache is None:
+        return
+    if username is None:
+        cache.clear()
+    else:
+        cache.delete(username)
 
 
 @peregrine.blueprints.blueprint.route("/graphql", methods=["POST"])
@@ -94,9 +135,24 @@ def root_graphql_query():
     variables, errors = peregrine.utils.get_variables(payload)
     if errors:
         return flask.jsonify({"data": None, "errors": errors}), 400
+    if wants_stream():
+        return do_graphql_stream(query, variables)
     return peregrine.utils.jsonify_check_errors(do_graphql_query(query, variables))
 
 
+def wants_stream():
+    """
+    Return True if the result should be streamed as newline-delimited JSON
+    (``?stream=true`` or ``Accept: application/x-ndjson``)
+    """
+    if flask.request.args.get("stream", "").lower() == "true":
+        return True
+    best = flask.request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]
+    )
+    return best == "application/x-ndjson"
+
+
 def do_graphql_query(query, variables):
     # Short circuit if user is not recognized. Make sure that the list of
     # projects that the user has read access to is set.
@@ -108,7 +164,88 @@ def do_graphql_query(query, variables):
     return graphql.execute_query(query, variables)
 
 
-def generate_schema_file(graphql_schema, app_logger):
+def do_graphql_stream(query, variables):
+    """
+    Run a graphql query and stream its result, one line per node of the
+    top-level list fields (see ``graphql.stream``).
+    """
+    try:
+        set_read_access_projects()
+    except AuthZError:
+        data = flask.jsonify({"data": {}, "errors": ["Unauthorized query."]})
+        return data, 403
+    lines, errors = graphql.stream_query(
+        query, variables, timeout=graphql.GRAPHQL_TIMEOUT
+    )
+    if errors:
+        return flask.jsonify({"data": None, "errors": errors}), 400
+    return flask.Response(
+        flask.stream_with_context(lines), mimetype="application/x-ndjson"
+    )
+
+
+def get_schema_file_name():
+    """
+    Return the name of the schema file for the current dictionary and
+    peregrine versions, e.g. ``schema-<hash>.json``: the introspection
+    result depends on both, and on the dictionary settings (e.g. the case
+    cache adds the ``_related_cases`` fields).
+    """
+    key = "{}:{}:{}:{}".format(
+        VERSION,
+        COMMIT,
+        dictionary.checksum(),
+        json.dumps(dictionary.settings, sort_keys=True, default=str),
+    )
+    return "schema-{}.json".format(hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+def get_schema_content(graphql_schema):
+    """
+    Run the graphql introspection query and return the result as JSON.
+    """
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    query_file = os.path.join(current_dir, "graphql", "introspection_query.txt")
+    with open(query_file, "r") as f:
+        query = f.read()
+
+    result = graphql_schema.execute(query)
+    data = {"data": result.data}
+    if result.errors:
+        data["errors"] = [
+            err.message if hasattr(err, "message") else str(err)
+            for err in result.errors
+        ]
+    return json.dumps(data)
+
+
+def write_schema_file(graphql_schema, schema_file):
+    """
+    Write the result of the graphql introspection query to ``schema_file``,
+    and a gzipped copy to ``schema_file + ".gz"``.
+    """
+    content = get_schema_content(graphql_schema)
+    write_file(schema_file, content)
+    write_gzipped_file(schema_file + ".gz", content)
+
+
+def write_file(path, content):
+    # write to a temporary file first so the file is never served partially
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_gzipped_file(path, content):
+    # write to a temporary file first so the file is never served partially
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def generate_schema_file(graphql_schema, app_logger, prebuilt_dir=None):
     """
     Load the graphql introspection query from its file.
     Because uwsgi launches multiple processes in the same container, processes
@@ -117,10 +254,22 @@ def generate_schema_file(graphql_schema, app_logger):
     Update: master process now handles app init - leaving the locking system in
     case it's needed later.
 
+    If ``prebuilt_dir`` contains the schema file generated by
+    ``bin/generate_schema.py`` for the current dictionary, it is used
+    instead.
+
     Return:
         str: the graphql introspection query
     """
-    current_dir = os.path.dirname(os.path.realpath(__file__))
+    if prebuilt_dir:
+        prebuilt_file = os.path.join(prebuilt_dir, get_schema_file_name())
+        if os.path.isfile(prebuilt_file):
+            app_logger.info("Using prebuilt schema file {}".format(prebuilt_file))
+            return os.path.abspath(prebuilt_file)
+        app_logger.warning(
+            "No prebuilt schema file {} for this dictionary".format(prebuilt_file)
+        )
+
     # relative to current running directory
     schema_file = "schema.json"
 
@@ -139,26 +288,19 @@ def generate_schema_file(graphql_schema, app_logger):
         except IOError:
             pass
 
-    query_file = os.path.join(current_dir, "graphql", "introspection_query.txt")
-    with open(query_file, "r") as f:
-        query = f.read()
-
     try:
         with open(schema_file, "w") as f:
             # lock file (prevents several processes from generating the schema at the same time)
             fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
             app_logger.info("Generating the graphql schema file {}".format(schema_file))
 
-            # generate the schema file
+            # generate the schema file, written to the locked file so that
+            # the other processes wait for it
             start = time.time()
-            result = graphql_schema.execute(query)
-            data = {"data": result.data}
-            if result.errors:
-                data["errors"] = [
-                    err.message if hasattr(err, "message") else str(err)
-                    for err in result.errors
-                ]
-            json.dump(data, f)
+            content = get_schema_content(graphql_schema)
+            f.write(content)
+            f.flush()
+            write_gzipped_file(schema_file + ".gz", content)
 
             end = int(round(time.time() - start))
             app_logger.info("Generated {} in {} sec".format(schema_file, end))
@@ -171,6 +313,15 @@ def generate_schema_file(graphql_schema, app_logger):
     return os.path.abspath(schema_file)
 
 
+def get_file_etag(path):
+    """Return a strong ETag for the contents of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def wait_for_file(file_name, timeout_minutes, app_logger):
     print("A process is waiting for {} generation.".format(file_name))
     timeout = time.time() + 60 * timeout_minutes
@@ -198,6 +349,19 @@ def root_graphql_schema_query():
     Get the graphql schema.
 
     Dig up the introspection query string from file, run it through graphql,
-    and jsonify the result.
+    and jsonify the result. The gzipped file is sent to clients accepting it,
+    and clients sending a matching ETag get a 304 response.
     """
-    return flask.send_file(flask.current_app.schema_file)
+    app = flask.current_app
+    gzipped_file = app.schema_file + ".gz"
+    if "gzip" in flask.request.accept_encodings and os.path.isfile(gzipped_file):
+        response = flask.send_file(
+            gzipped_file,
+            mimetype="application/json",
+            etag=app.schema_etag + "-gzip",
+        )
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = flask.send_file(app.schema_file, etag=app.schema_etag)
+    response.vary.add("Accept-Encoding")
+    return response
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 
 import flask
@@ -6,6 +8,7 @@ import graphql
 
 from peregrine import dictionary
 from peregrine.utils.pyutils import log_duration
+from .backend import CachedDocumentBackend, normalize_query
 from .node import (
     NodeField,
     create_root_fields,
@@ -28,6 +31,7 @@ from .transaction import (
     resolve_transaction_log,
     resolve_transaction_log_count,
 )
+from .stream import stream_query
 from .traversal import make_graph_traversal_dict
 from .util import set_session_timeout
 
@@ -88,6 +92,31 @@ def get_schema():
     return Schema
 
 
+def get_result_cache_key(query, variables, app):
+    """
+    Build the key of the result of a query in ``app.graphql_result_cache``
+    from the normalized query, the variables and the projects the user has
+    read access to, so that results are only shared between users with the
+    same access.
+
+    Return None if the result cannot be cached.
+    """
+    if not flask.has_request_context() or "read_access_projects" not in flask.g:
+        return None
+    try:
+        normalized_query = normalize_query(
+            query, app.graphql_schema, getattr(app, "graphql_backend", None)
+        )
+    except graphql.error.GraphQLError:
+        return None
+    key = json.dumps(
+        [normalized_query, variables, sorted(flask.g.read_access_projects)],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
 def execute_query(query, variables=None, app=None):
     """
     Pull required parameters from global request and execute GraphQL query.
@@ -98,6 +127,14 @@ def execute_query(query, variables=None, app=None):
     if app is None:
         app = flask.current_app
 
+    result_cache = getattr(app, "graphql_result_cache", None)
+    cache_key = None
+    if result_cache is not None:
+        cache_key = get_result_cache_key(query, variables, app)
+        data = result_cache.get(cache_key) if cache_key else None
+        if data is not None:
+            return data, []
+
     # Execute query
     try:
         session_scope = app.db.session_scope()
@@ -108,7 +145,10 @@ def execute_query(query, variables=None, app=None):
                 set_session_timeout(session, GRAPHQL_TIMEOUT)
                 # result = Schema.execute(query, variable_values=variables)
                 result = app.graphql_schema.execute(
-                    query, variable_values=variables, return_promise=True
+                    query,
+                    variable_values=variables,
+                    backend=getattr(app, "graphql_backend", None),
+                    return_promise=True,
                 )
                 NodeCounter.current().run(session)
                 result = result.get()
@@ -131,4 +171,7 @@ def execute_query(query, variables=None, app=None):
         if "TimeoutException" in errors:
             errors.append(TIMEOUT_MESSAGE.format(GRAPHQL_TIMEOUT))
 
+    if cache_key and not errors:
+        result_cache.set(cache_key, result.data)
+
     return result.data, errors
@@ -0,0 +1,320 @@
+"""
+Materialized ancestor mappings: for a configured pair of node types, e.g.
+``submitted_unaligned_reads`` -> ``case``, a table row maps each node of the
+first type to each node of the second type it has a path to. A
+``with_path_to`` filter between the two types is then a lookup in that table
+instead of a traversal of every path.
+
+The mappings are (re)built by ``bin/rebuild_ancestors.py``, which also
+installs triggers on the edge tables along the paths: they mark a mapping as
+stale when these tables change. A mapping is not used while it is stale (until
+it is rebuilt), nor if the triggers of any of its edge tables are missing.
+
+The rows are not maintained incrementally: any write to one of the edge tables
+(e.g. a new submission) makes the mapping stale, and the filters traverse the
+paths until the next rebuild. The mappings only pay off for data that changes
+less often than they are rebuilt.
+"""
+
+import threading
+import time
+
+from cdislogging import get_logger
+from psqlgraph import Node
+from psqlgraph.query import GraphQuery
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from .traversal import get_paths_between
+
+logger = get_logger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+metadata = sa.MetaData()
+
+node_ancestors = sa.Table(
+    "_node_ancestors",
+    metadata,
+    sa.Column("label", sa.Text, primary_key=True),
+    sa.Column("ancestor_label", sa.Text, primary_key=True),
+    sa.Column("node_id", sa.Text, primary_key=True),
+    sa.Column("ancestor_id", sa.Text, primary_key=True),
+    sa.Index("_node_ancestors_ancestor_idx", "ancestor_label", "ancestor_id"),
+)
+
+ancestor_mappings = sa.Table(
+    "_node_ancestor_mappings",
+    metadata,
+    sa.Column("label", sa.Text, primary_key=True),
+    sa.Column("ancestor_label", sa.Text, primary_key=True),
+    sa.Column("edge_tables", ARRAY(sa.Text), nullable=False),
+    sa.Column("built", sa.DateTime, nullable=False),
+    sa.Column("stale", sa.Boolean, nullable=False, default=False),
+)
+
+MARK_STALE_FUNCTION = """
+CREATE OR REPLACE FUNCTION _mark_node_ancestors_stale() RETURNS trigger AS $$
+BEGIN
+    UPDATE _node_ancestor_mappings SET stale = true
+    WHERE NOT stale AND TG_TABLE_NAME = ANY(edge_tables);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+STALE_TRIGGER = "_node_ancestors_stale"
+
+
+def get_path_edges(src_label, path):
+    """
+    Return the list of ``(edge class, this_id column, next_id column)``
+    followed by a path string starting from ``src_label``.
+    """
+    entity = Node.get_subclass(src_label)
+    edges = []
+    for link in path.split("."):
+        edge, this_id, next_id, entity = GraphQuery._get_link_details(entity, link)
+        edges.append((edge, this_id, next_id))
+    return edges
+
+
+def select_path_pairs(src_label, path):
+    """
+    Select the ``(node_id, ancestor_id)`` pairs connected by a path, joining
+    the edge tables only.
+    """
+    edges = []
+    for edge, this_id, next_id in get_path_edges(src_label, path):
+        table = edge.__table__.alias()
+        edges.append((table, table.c[this_id.key], table.c[next_id.key]))
+    from_clause = edges[0][0]
+    for previous, current in zip(edges, edges[1:]):
+        from_clause = from_clause.join(current[0], current[1] == previous[2])
+    return sa.select(
+        edges[0][1].label("node_id"), edges[-1][2].label("ancestor_id")
+    ).select_from(from_clause)
+
+
+def create_tables(engine):
+    metadata.create_all(engine)
+    engine.execute(MARK_STALE_FUNCTION)
+
+
+def drop_tables(engine):
+    """Drop the mappings and the triggers marking them as stale"""
+    engine.execute("DROP FUNCTION IF EXISTS _mark_node_ancestors_stale() CASCADE")
+    metadata.drop_all(engine)
+
+
+def rebuild(db, src_label, dst_label, app):
+    """
+    Rebuild the mapping of the ``src_label`` nodes to their ``dst_label``
+    ancestors and install the triggers marking it as stale, in a single
+    transaction.
+
+    Args:
+        db (psqlgraph.PsqlGraphDriver): database driver
+        src_label (str): label of the nodes to map
+        dst_label (str): label of the ancestors
+        app (flask.Flask): app holding the graph traversals
+
+    Returns:
+        int: number of rows in the mapping
+    """
+    paths = get_paths_between(src_label, dst_label, app)
+    if not paths:
+        raise ValueError("There is no path from {} to {}".format(src_label, dst_label))
+    edge_tables = sorted(
+        {
+            edge.__tablename__
+            for path in paths
+            for edge, _, _ in get_path_edges(src_label, path)
+        }
+    )
+    pairs = sa.union(*[select_path_pairs(src_label, path) for path in paths])
+    pairs = pairs.subquery()
+    pair_filter = sa.and_(
+        node_ancestors.c.label == src_label,
+        node_ancestors.c.ancestor_label == dst_label,
+    )
+
+    with db.engine.begin() as conn:
+        for table in edge_tables:
+            conn.execute(
+                'DROP TRIGGER IF EXISTS {trigger} ON "{table}"'.format(
+                    trigger=STALE_TRIGGER, table=table
+                )
+            )
+            conn.execute(
+                "CREATE TRIGGER {trigger} AFTER INSERT OR UPDATE OR DELETE OR "
+                'TRUNCATE ON "{table}" FOR EACH STATEMENT EXECUTE PROCEDURE '
+                "_mark_node_ancestors_stale()".format(
+                    trigger=STALE_TRIGGER, table=table
+                )
+            )
+
+        conn.execute(node_ancestors.delete().where(pair_filter))
+        conn.execute(
+            node_ancestors.insert().from_select(
+                ["label", "ancestor_label", "node_id", "ancestor_id"],
+                sa.select(
+                    sa.literal(src_label),
+                    sa.literal(dst_label),
+                    pairs.c.node_id,
+                    pairs.c.ancestor_id,
+                ),
+            )
+        )
+        conn.execute(
+            ancestor_mappings.delete().where(
+                sa.and_(
+                    ancestor_mappings.c.label == src_label,
+                    ancestor_mappings.c.ancestor_label == dst_label,
+                )
+            )
+        )
+        conn.execute(
+            ancestor_mappings.insert().values(
+                label=src_label,
+                ancestor_label=dst_label,
+                edge_tables=edge_tables,
+                built=sa.func.now(),
+                stale=False,
+            )
+        )
+        return conn.execute(
+            sa.select(sa.func.count()).select_from(node_ancestors).where(pair_filter)
+        ).scalar()
+
+
+def fresh_clause(label, ancestor_label):
+    """Return a SQL condition that is true if the mapping from ``label`` to
+    ``ancestor_label`` is built and not stale"""
+    return sa.exists().where(
+        sa.and_(
+            ancestor_mappings.c.label == label,
+            ancestor_mappings.c.ancestor_label == ancestor_label,
+            sa.not_(ancestor_mappings.c.stale),
+        )
+    )
+
+
+def ancestors_clause(q, dst_label, post_filter=None, correlated=False, fallback=None):
+    """Return a SQL condition on the entity of ``q`` that is true if it has
+    an ancestor with label :param:`dst_label` matching :param:`post_filter`
+    in the materialized mapping (see ``traversal.paths_clause``).
+
+    The mapping can become stale after :class:`AncestorMappings` loaded it,
+    so its state is checked by the query itself: if it is stale, the
+    :param:`fallback` condition (e.g. the traversal of the paths) is used
+    instead.
+    """
+    clause = _ancestors_clause(q, dst_label, post_filter, correlated)
+    fresh = fresh_clause(q.entity().label, dst_label)
+    if fallback is None:
+        return sa.and_(fresh, clause)
+    # Postgres evaluates the uncorrelated EXISTS once, and the branch it
+    # rules out is not run
+    return sa.or_(sa.and_(fresh, clause), sa.and_(sa.not_(fresh), fallback))
+
+
+def _ancestors_clause(q, dst_label, post_filter=None, correlated=False):
+    entity = q.entity()
+    target = Node.get_subclass(dst_label)
+    end_q = q.session.query(target)
+    if post_filter is not None:
+        end_q = post_filter(end_q)
+
+    rows = node_ancestors.c
+    clause = sa.and_(rows.label == entity.label, rows.ancestor_label == dst_label)
+    if end_q.whereclause is not None:
+        if correlated:
+            clause = sa.and_(
+                clause,
+                sa.exists()
+                .where(target.node_id == rows.ancestor_id)
+                .where(end_q.whereclause),
+            )
+        else:
+            target_ids = sa.select(target.node_id).where(end_q.whereclause)
+            clause = sa.and_(clause, rows.ancestor_id.in_(target_ids))
+    if correlated:
+        return sa.exists().where(rows.node_id == entity.node_id).where(clause)
+    return entity.node_id.in_(sa.select(rows.node_id).where(clause))
+
+
+def get_triggered_tables(conn):
+    """Return the names of the tables with an enabled stale trigger"""
+    return {
+        table
+        for (table,) in conn.execute(
+            sa.text(
+                "SELECT c.relname FROM pg_trigger t "
+                "JOIN pg_class c ON c.oid = t.tgrelid "
+                "WHERE t.tgname = :trigger AND t.tgenabled <> 'D'"
+            ),
+            {"trigger": STALE_TRIGGER},
+        )
+    }
+
+
+class AncestorMappings(object):
+    """
+    The ``(label, ancestor_label)`` pairs whose mapping is built, not stale
+    and kept up to date by the triggers of its edge tables, reloaded when
+    older than the refresh interval.
+    """
+
+    def __init__(self, db, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        Args:
+            db (psqlgraph.PsqlGraphDriver): database driver
+            refresh_interval (float): seconds before the pairs are reloaded
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._pairs = frozenset()
+
+    def invalidate(self):
+        """Reload the pairs on their next use"""
+        self._loaded_at = None
+
+    def load(self):
+        if not sa.inspect(self.db.engine).has_table(ancestor_mappings.name):
+            pairs = []
+        else:
+            with self.db.engine.connect() as conn:
+                triggered_tables = get_triggered_tables(conn)
+                pairs = [
+                    (label, ancestor)
+                    for label, ancestor, edge_tables in conn.execute(
+                        sa.select(
+                            ancestor_mappings.c.label,
+                            ancestor_mappings.c.ancestor_label,
+                            ancestor_mappings.c.edge_tables,
+                        ).where(sa.not_(ancestor_mappings.c.stale))
+                    )
+                    # without the triggers, the mapping could be out of date
+                    if triggered_tables.issuperset(edge_tables)
+                ]
+        self._pairs = frozenset(pairs)
+        self._loaded_at = time.time()
+
+    def has(self, label, ancestor_label):
+        """Return True if the mapping from ``label`` to ``ancestor_label``
+        can be used"""
+        with self._lock:
+            if (
+                self._loaded_at is None
+                or time.time() - self._loaded_at > self.refresh_interval
+            ):
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.warning("Unable to load the ancestor mappings: %s", e)
+                    self._pairs = frozenset()
+                    self._loaded_at = time.time()
+            return (label, ancestor_label) in self._pairs
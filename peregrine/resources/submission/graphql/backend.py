@@ -0,0 +1,82 @@
+"""
+GraphQL backend caching the parsed and validated query documents, so that
+repeated queries skip parsing and validation and go straight to execution.
+"""
+
+from functools import partial
+import hashlib
+
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language.base import parse, print_ast
+from graphql.validation import validate
+
+
+def invalid_result(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+class CachedDocumentBackend(GraphQLCoreBackend):
+    def __init__(self, cache, executor=None):
+        """
+        Args:
+            cache (peregrine.utils.MemoryCache):
+                cache for the documents, keyed by the hash of the query text
+        """
+        super(CachedDocumentBackend, self).__init__(executor=executor)
+        self.cache = cache
+
+    def document_from_string(self, schema, document_string):
+        key = hashlib.sha256(document_string.encode("utf-8")).hexdigest()
+        document = self.cache.get(key)
+        if document is None or document.schema is not schema:
+            # syntax errors are raised here and not cached
+            document_ast = parse(document_string)
+            validation_errors = validate(schema, document_ast)
+            if validation_errors:
+                execute_document = partial(invalid_result, validation_errors)
+            else:
+                execute_document = partial(
+                    execute, schema, document_ast, **self.execute_params
+                )
+            document = GraphQLDocument(
+                schema=schema,
+                document_string=document_string,
+                document_ast=document_ast,
+                execute=execute_document,
+            )
+            # canonical text of the query, see ``normalize_query``
+            document.normalized_string = print_ast(document_ast)
+            # see ``parse_query``
+            document.validation_errors = validation_errors
+            self.cache.set(key, document)
+        return document
+
+
+def normalize_query(query, schema, backend=None):
+    """
+    Return the query text in a canonical form (whitespace, commas and
+    comments removed), using the documents cached by ``backend`` if any.
+
+    Raises:
+        graphql.error.GraphQLSyntaxError: if the query cannot be parsed
+    """
+    if isinstance(backend, CachedDocumentBackend):
+        return backend.document_from_string(schema, query).normalized_string
+    return print_ast(parse(query))
+
+
+def parse_query(query, schema, backend=None):
+    """
+    Return the AST of the query and its validation errors, using the
+    documents cached by ``backend`` if any.
+
+    Raises:
+        graphql.error.GraphQLSyntaxError: if the query cannot be parsed
+    """
+    if isinstance(backend, CachedDocumentBackend):
+        document = backend.document_from_string(schema, query)
+        return document.document_ast, document.validation_errors
+    document_ast = parse(query)
+    return document_ast, validate(schema, document_ast)
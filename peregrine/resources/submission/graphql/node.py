@@ -10,35 +10,47 @@ using the Graphene GraphQL library
 
 from flask import current_app as capp
 from dateutil.parser import parse
+import base64
+import binascii
 import flask
 import graphene
+import json
 import logging
 import psqlgraph
 import re
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
 
 from datamodelutils import models as md  # noqa
 from promise import Promise
+from promise.dataloader import DataLoader
 
 from peregrine import dictionary
 from .util import (
     apply_arg_limit,
     apply_arg_offset,
-    clean_count,
+    clean_count_statement,
     get_authorized_query,
     get_fields as util_get_fields,
     filtered_column_dict,
+    apply_props_only,
+    get_loaded_columns,
+    get_props_columns,
+    is_query_canceled,
+    iter_query,
     DEFAULT_LIMIT,
 )
 
-from . import transaction
-from .traversal import subq_paths
+from . import quicksearch, transaction
+from .ancestors import ancestors_clause
+from .traversal import make_path_tree, path_tree_clause, paths_clause
 
 from peregrine.resources.submission.constants import case_cache_enabled
 
 logging.root.setLevel(level=logging.INFO)
 
 COUNT_NAME = "_{}_count"
+PAGE_INFO_NAME = "_{}_page_info"
 __gql_object_classes = {}
 
 
@@ -51,6 +63,23 @@ def get_link_attr(cls, link):
     return getattr(cls, link)
 
 
+def get_link_edge(cls, link):
+    """Return the edge class backing the link :param:`link` of
+    :param:`cls`, along with the edge columns holding the ids of the
+    ``cls`` node and of its neighbor, respectively.
+
+    """
+
+    for edge in psqlgraph.Edge._get_edges_with_src(cls.__name__):
+        if edge.__src_dst_assoc__ == link:
+            return edge, edge.src_id, edge.dst_id
+    for edge in psqlgraph.Edge._get_edges_with_dst(cls.__name__):
+        if edge.__dst_src_assoc__ == link:
+            return edge, edge.dst_id, edge.src_id
+
+    raise RuntimeError("Invalid link name '{}'".format(link))
+
+
 # ======================================================================
 # Filters
 
@@ -83,20 +112,28 @@ def filter_project_project_id(q, value, info):
     return q
 
 
-def with_path_to(q, value, info, union=False, name="with_path_to"):
+def with_path_to(q, value, info, union=False, name="with_path_to", negate=False):
     """This will traverse any (any meaning any paths specified in the path
     generation heuristic which prunes some redundant/wandering paths)
     from the source entity to the given target type where it will
     apply a given query.
 
-    This filter is a logical conjunction (*AND*) over subfilters.
+    This filter is a logical conjunction (*AND*) over subfilters, or a
+    disjunction (*OR*) if :param:`union`. If :param:`negate`, the entities
+    matching the filter are excluded instead.
+
+    With the ``WITH_PATH_TO_MODE`` setting set to ``"exists"``, the filter
+    is a single correlated ``EXISTS`` predicate on :param:`q` instead of
+    set operations over subqueries, so that a query with a limit can stop
+    at the first matching entities.
 
     """
 
     if not isinstance(value, list):
         value = [value]
 
-    union_qs = []
+    correlated = capp.config.get("WITH_PATH_TO_MODE") == "exists"
+    clauses = []
 
     for entry in value:
         entry = dict(entry)
@@ -130,39 +167,68 @@ def with_path_to(q, value, info, union=False, name="with_path_to"):
             # Rely on shortcut link to case, if it doesn't exist, then
             # this entity does not relate to any cases
             if hasattr(q.entity(), "_related_cases"):
-                subq = q.subq_path("_related_cases", end_of_traversal_filter)
+                clause = path_tree_clause(
+                    q,
+                    q.entity(),
+                    make_path_tree(["_related_cases"]),
+                    end_of_traversal_filter,
+                    correlated,
+                )
             else:
-                subq = q.filter(sa.sql.false())
+                clause = sa.sql.false()
 
         # Special case for traversing FROM case
         elif case_cache_enabled() and q.entity().label == "case":
             link = "_related_{}".format(dst_type)
             q = q.limit(None)
             if hasattr(q.entity(), link):
-                subq = q.subq_path(link, end_of_traversal_filter)
+                clause = path_tree_clause(
+                    q,
+                    q.entity(),
+                    make_path_tree([link]),
+                    end_of_traversal_filter,
+                    correlated,
+                )
             else:
-                subq = q.filter(sa.sql.false())
+                clause = sa.sql.false()
+
+        # Use the materialized ancestors of the entity if they are built
+        elif capp.ancestor_mappings and capp.ancestor_mappings.has(
+            q.entity().label, dst_type
+        ):
+            clause = ancestors_clause(
+                q,
+                dst_type,
+                end_of_traversal_filter,
+                correlated,
+                fallback=paths_clause(q, dst_type, end_of_traversal_filter, correlated),
+            )
 
         # Otherwise do a full traversal
         else:
-            subq = subq_paths(q, dst_type, end_of_traversal_filter)
+            clause = paths_clause(q, dst_type, end_of_traversal_filter, correlated)
+
+        clauses.append(clause)
 
-        # Add the subq for this dst_type (multiplex on :param:`union`)
-        if union:
-            union_qs += [subq]
+    if correlated:
+        if not clauses:
+            clause = sa.sql.false() if union else sa.sql.true()
         else:
-            q = subq
+            clause = sa.or_(*clauses) if union else sa.and_(*clauses)
+        return q.filter(sa.not_(clause) if negate else clause)
 
     # Construct final query (multiplex on :param:`union`)
-    if union and union_qs:
+    if union and clauses:
         # If we are taking a union of the paths (i.e. OR) compile the union
-        q = union_qs.pop(0)
-        for union_q in union_qs:
-            q = q.union(union_q)
-    elif union and not union_qs:
-        q = q.filter(sa.sql.false())
+        subq = q.filter(clauses.pop(0))
+        for clause in clauses:
+            subq = subq.union(q.filter(clause))
+    elif union and not clauses:
+        subq = q.filter(sa.sql.false())
+    else:
+        subq = q.filter(*clauses)
 
-    return q
+    return q.except_(subq) if negate else subq
 
 
 def apply_arg_quicksearch(q, args, info):
@@ -172,6 +238,13 @@ def apply_arg_quicksearch(q, args, info):
     Currently, for simplicity and performance, only the
     ``id`` and ``submitter_id`` are being used in this filter.
 
+    The search phrase is matched literally (``%`` and ``_`` are not
+    wildcards), in a single scan of the table that the planner can
+    answer with the trigram indexes of both columns (see
+    ``quicksearch``). Unless another order is requested, the nodes of a
+    truncated result are ordered by the length of their submitter_id, so
+    that the closest matches come first.
+
     TODO: make this filter more general. Previous attempts:
 
         1. included taking a query over subqueries for each unique key
@@ -198,27 +271,149 @@ def apply_arg_quicksearch(q, args, info):
     # The node class
     cls = q.entity()
 
-    node_id_attr = sa.func.lower(cls.node_id)
-    sub_id_attr = cls._props["submitter_id"].astext
-
-    # Search for ids that contain the search_phrase
-    node_id_query = q.filter(node_id_attr.contains(search_phrase))
-    # Search for submitter_ids that contain the search phrase
-    sub_id_query = q.filter(sa.func.lower(sub_id_attr).contains(search_phrase))
-    # Take the union of those queries
-    q = node_id_query.union(sub_id_query)
-    # Heuristic ordering based on length
-    q.order_by(sa.func.length(sub_id_attr))
+    node_id_attr, sub_id_attr = quicksearch.get_search_expressions(cls)
 
+    # Search for ids or submitter_ids that contain the search_phrase
+    q = q.filter(
+        sa.or_(
+            node_id_attr.contains(search_phrase, autoescape=True),
+            sub_id_attr.contains(search_phrase, autoescape=True),
+        )
+    )
     return q
 
 
-def apply_query_args(q, args, info):
+def get_quicksearch_order_by(cls, args):
+    """Return the heuristic ORDER BY clauses of ``quick_search`` (see
+    :func:`apply_arg_quicksearch`): by length of the submitter_id, when no
+    other order is requested and the order selects the nodes returned.
+
+    """
+
+    truncated = args.get("first", DEFAULT_LIMIT) > 0 or args.get("offset", 0) > 0
+    if (
+        not args.get("quick_search")
+        or not truncated
+        or get_arg_sort_keys(cls, args)
+        or args.get("after")
+    ):
+        return []
+    _, sub_id_attr = quicksearch.get_search_expressions(cls)
+    return [sa.func.length(sub_id_attr)]
+
+
+def get_arg_sort_keys(cls, args):
+    """Return the list of ``(expression, direction)`` sort keys requested
+    by the ``order_by_asc`` and ``order_by_desc`` arguments (in that
+    order).
+
+    """
+
+    sort_keys = []
+    for arg, direction in [("order_by_asc", sa.asc), ("order_by_desc", sa.desc)]:
+        if arg not in args:
+            continue
+        key = args[arg]
+        if key == "id":
+            sort_keys.append((cls.node_id, direction))
+        elif key in ["type"]:
+            pass
+        elif key in cls.__pg_properties__:
+            sort_keys.append((cls._props[key], direction))
+        else:
+            raise RuntimeError("Cannot order by {} on {}".format(key, cls.label))
+
+    return sort_keys
+
+
+def get_arg_order_by(cls, args):
+    """Return the list of ORDER BY clauses requested by the
+    ``order_by_asc`` and ``order_by_desc`` arguments (in that order).
+
+    """
+
+    return [
+        direction(expression) for expression, direction in get_arg_sort_keys(cls, args)
+    ]
+
+
+def get_keyset_sort_keys(cls, args):
+    """Return the sort keys of :func:`get_arg_sort_keys` followed by
+    ``node_id``, so that the order is total and a cursor designates a
+    single position in it.
+
+    """
+
+    sort_keys = get_arg_sort_keys(cls, args)
+    if not any(expression is cls.node_id for expression, _ in sort_keys):
+        sort_keys.append((cls.node_id, sa.asc))
+    return sort_keys
+
+
+def encode_cursor(values):
+    """Return an opaque cursor for the sort key values of a node"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError, binascii.Error):
+        values = None
+    if not isinstance(values, list) or len(values) != length:
+        raise RuntimeError("Invalid cursor {}".format(cursor))
+    return values
+
+
+def get_cursor_columns(cls, args):
+    """Return the columns to select to build the cursor of a node"""
+    return [
+        expression if expression is cls.node_id else sa.cast(expression, sa.Text)
+        for expression, _ in get_keyset_sort_keys(cls, args)
+    ]
+
+
+def apply_arg_after(q, args, info):
+    """The ``after`` argument selects the nodes following the position of
+    a cursor (see :func:`resolve_page_info`) in the order of the sort
+    keys, which unlike ``offset`` does not scan the previous pages.
+
+    Missing values sort last in ascending order and first in descending
+    order, as in Postgres.
+
+    """
+
+    sort_keys = get_keyset_sort_keys(q.entity(), args)
+    values = decode_cursor(args["after"], len(sort_keys))
+
+    # (k1 after v1) OR (k1 = v1 AND ((k2 after v2) OR (k2 = v2 AND ...)))
+    clause = sa.sql.false()
+    for (expression, direction), value in reversed(list(zip(sort_keys, values))):
+        if expression is not q.entity().node_id and value is not None:
+            # the cursor holds the text of the JSONB values (see
+            # get_cursor_columns), to tell JSON nulls from missing values
+            value = sa.cast(sa.literal(value), JSONB)
+        if value is None:
+            equal = expression.is_(None)
+            after = expression.isnot(None) if direction is sa.desc else sa.sql.false()
+        else:
+            equal = expression == value
+            if direction is sa.desc:
+                after = expression < value
+            else:
+                after = sa.or_(expression > value, expression.is_(None))
+        clause = sa.or_(after, sa.and_(equal, clause))
+    return q.filter(clause)
+
+
+def apply_query_args(q, args, info, keyset=False):
     """
     Args:
         q: psqlgraph query
         args: dictionary of the arguments passed to the query.
         info: graphene object that holds the query's arguments, models and requested fields.
+        keyset: order by the sort keys of the cursors (see
+            :func:`get_keyset_sort_keys`), which ``after`` implies.
     """
 
     pg_props = set(getattr(q.entity(), "__pg_properties__", {}).keys())
@@ -237,9 +432,9 @@ def apply_query_args(q, args, info):
         field_type = q.entity().__pg_properties__[key][0]
         if field_type == list:
             # This field has type list. Return supersets of input (i.e. do AND filter)
-            q = q.filter(
-                *[q.entity()._props[key].astext.like('%"' + v + '"%') for v in val]
-            )
+            # with a JSONB containment, which the GIN indexes of _props can answer
+            if val:
+                q = q.filter(q.entity()._props.contains({key: [str(v) for v in val]}))
         else:
             # This field has scalar type. Treat input as several queries (i.e. do OR filter)
             if field_type == bool:
@@ -333,8 +528,8 @@ def apply_query_args(q, args, info):
 
     # without_path_to: (filter for those missing a given traversal)
     if "without_path_to" in args:
-        q = q.except_(
-            with_path_to(q, args["without_path_to"], info, name="without_path_to")
+        q = with_path_to(
+            q, args["without_path_to"], info, name="without_path_to", negate=True
         )
 
     # project.project_id: Filter projects by logical project_id
@@ -342,33 +537,25 @@ def apply_query_args(q, args, info):
         # Special case for filtering project by project_id
         q = filter_project_project_id(q, args["project_id"], info)
 
-    # order_by_asc: Apply an ordering to the results
-    # (ascending). NOTE: should be after all other non-ordering,
-    # before limit, offset queries
-    if "order_by_asc" in args:
-        key = args["order_by_asc"]
-        if key == "id":
-            q = q.order_by(q.entity().node_id)
-        elif key in ["type"]:
-            pass
-        elif key in q.entity().__pg_properties__:
-            q = q.order_by(q.entity()._props[key])
-        else:
-            raise RuntimeError("Cannot order by {} on {}".format(key, q.entity().label))
-
-    # order_by_desc: Apply an ordering to the results (descending)
-    # NOTE: should be after all other non-ordering, before limit,
-    # offset queries
-    if "order_by_desc" in args:
-        key = args["order_by_desc"]
-        if key == "id":
-            q = q.order_by(q.entity().node_id.desc())
-        elif key in ["type"]:
-            pass
-        elif key in q.entity().__pg_properties__:
-            q = q.order_by(q.entity()._props[key].desc())
-        else:
-            raise RuntimeError("Cannot order by {} on {}".format(key, q.entity().label))
+    # order_by_asc, order_by_desc: Apply an ordering to the
+    # results. NOTE: should be after all other non-ordering, before
+    # limit, offset queries
+    # after: keyset pagination, continue from the position of a cursor
+    if args.get("after"):
+        q = apply_arg_after(q, args, info)
+
+    # quick_search: closest matches first (see ``apply_arg_quicksearch``)
+    quicksearch_order_by = get_quicksearch_order_by(q.entity(), args)
+    if keyset or args.get("after") or quicksearch_order_by:
+        # break the ties so that cursors designate a single position
+        order_by = quicksearch_order_by + [
+            direction(expression)
+            for expression, direction in get_keyset_sort_keys(q.entity(), args)
+        ]
+    else:
+        order_by = get_arg_order_by(q.entity(), args)
+    if order_by:
+        q = q.order_by(*order_by)
 
     # first: truncate result list
     q = apply_arg_limit(q.from_self(), args, info)
@@ -405,6 +592,13 @@ def load_node(n, info, fields_depend_on_columns=None):
     )
 
 
+def load_row(row, label):
+    """Turns a row selected by ``apply_props_only`` (the node id and the
+    properties required for query) into the dictionary of ``load_node``.
+    """
+    return dict(row._mapping, type=label)
+
+
 class Node(graphene.Interface):
     """The query object that represents the psqlgraph.Node base"""
 
@@ -454,7 +648,11 @@ def resolve_node(self, info, **args):
 
 def query_with_args(classes, args, info):
     """
-    Run queries with arguments.
+    Run queries with arguments and yield the nodes (see ``iter_query``).
+
+    The nodes of several classes are selected in a single statement, so
+    that the ordering, ``first`` and ``offset`` apply to all of them (see
+    ``query_union``).
 
     Args:
         classes: psqlgraph classes to query.
@@ -464,7 +662,7 @@ def query_with_args(classes, args, info):
     of_types = [
         psqlgraph.Node.get_subclass(label) for label in set(args.get("of_type", []))
     ]
-    all_items = []
+    queries = []
     for cls in classes:
         if not of_types or cls in of_types:
             q = get_authorized_query(cls)
@@ -472,48 +670,179 @@ def query_with_args(classes, args, info):
                 q = q.filter(
                     q.entity()._props["project_id"].astext == args["project_id"]
                 )
+            queries.append(q)
 
-            q = apply_query_args(q, args, info)
-            all_items.extend(q.all())
-
-    return all_items
+    if not queries:
+        return
+    if len(queries) == 1:
+        q = apply_query_args(queries[0], args, info)
+    else:
+        q = query_union([apply_filter_args(q, args, info) for q in queries], args, info)
+    for n in iter_query(q):
+        yield n
 
 
 def query_node_with_args(args, info):
     """
     Run queries with arguments for Node only.
 
-    This is identical to `query_with_args` unless `of_type` is present - when it falls
-    back to an ancient implementation to handle `of_type` for compatibility.
-
-    XXX: These two methods may be rewritten in a more efficient and consistent way.
+    This is identical to `query_with_args` unless `of_type` is present - when
+    the nodes of these types are selected in a single statement (see
+    `query_union`).
     """
+    indexed_classes = get_indexed_classes(args)
     if "of_type" in args:
-        # TODO: (jsm) find a better solution.  currently this filter
-        # will do a subquery for each type AND LOAD THE IDS of all the
-        # nodes, then perform a second query given those ids.  We
-        # cannot do a ``select_from`` because it does not work
-        # properly for the abstract base class with concrete table
-        # inheritance (a.k.a it can't find the colums for Node)
-        of_types = set(args["of_type"])
-        ids = []
-        for label in of_types:
-            entity = psqlgraph.Node.get_subclass(label)
-            q = get_authorized_query(entity)
-            q = apply_query_args(q, args, info)
-            try:
-                ids += [n.node_id for n in q.all()]
-            except Exception as e:
-                capp.logger.exception(e)
-                raise
-        q = get_authorized_query(psqlgraph.Node).ids(ids)
-        q = apply_arg_limit(q, args, info)
-        q = apply_arg_offset(q, args, info)
-        return q.all()
+        classes = [
+            psqlgraph.Node.get_subclass(label) for label in sorted(set(args["of_type"]))
+        ]
+        if indexed_classes is not None:
+            classes = [cls for cls in classes if cls in indexed_classes]
+        if not classes:
+            return iter([])
+        queries = [
+            apply_filter_args(get_authorized_query(cls), args, info) for cls in classes
+        ]
+        return iter_query(query_union(queries, args, info))
+    elif indexed_classes is not None:
+        # the orders allowed on the psqlgraph.Node base only
+        get_arg_sort_keys(psqlgraph.Node, args)
+        return query_with_args(indexed_classes, args, info)
     else:
         return query_with_args([psqlgraph.Node], args, info)
 
 
+def get_indexed_classes(args):
+    """
+    Return the classes of the nodes matching the ``id``, ``ids`` and
+    ``submitter_id`` arguments in the node index (see ``node_index``), so
+    that only their tables are queried, or None if the index is not used.
+    """
+    if not capp.node_index or not any(
+        key in args for key in ["id", "ids", "submitter_id"]
+    ):
+        return None
+    if not capp.node_index.is_ready():
+        return None
+    node_ids = None
+    for key in ["id", "ids"]:
+        if key in args:
+            val = args[key] if isinstance(args[key], list) else [args[key]]
+            node_ids = set(val) if node_ids is None else node_ids & set(val)
+    submitter_ids = [args["submitter_id"]] if "submitter_id" in args else None
+    labels = capp.node_index.get_labels(
+        capp.db.current_session(), node_ids=node_ids, submitter_ids=submitter_ids
+    )
+    classes = [psqlgraph.Node.get_subclass(label) for label in sorted(labels)]
+    # labels removed from the dictionary since the index was built
+    return [cls for cls in classes if cls is not None]
+
+
+def query_indexed_neighbors(node_id, args, info):
+    """
+    Yield the nodes linked to a node and matching the arguments, querying
+    only the tables of the neighbors found in the node index.
+    """
+    edges = (
+        capp.db.edges()
+        .filter(
+            sa.or_(psqlgraph.Edge.src_id == node_id, psqlgraph.Edge.dst_id == node_id)
+        )
+        .with_entities(psqlgraph.Edge.src_id, psqlgraph.Edge.dst_id)
+    )
+    neighbor_ids = {dst_id if src_id == node_id else src_id for src_id, dst_id in edges}
+    if "ids" in args:
+        neighbor_ids &= set(args["ids"])
+    # like the unindexed query, _links are not limited
+    args = dict(args, ids=sorted(neighbor_ids), first=0)
+    get_arg_sort_keys(psqlgraph.Node, args)
+    for cls in get_indexed_classes(args):
+        q = apply_query_args(get_authorized_query(cls), args, info)
+        for n in iter_query(q):
+            yield n
+
+
+def apply_filter_args(q, args, info):
+    """Apply the arguments filtering the nodes, leaving the ordering,
+    ``first`` and ``offset`` to the caller (see ``query_union``)"""
+    filter_args = {
+        key: value
+        for key, value in args.items()
+        if key not in ["first", "offset", "order_by_asc", "order_by_desc"]
+    }
+    return apply_query_args(q, dict(filter_args, first=0), info)
+
+
+def query_union(queries, args, info):
+    """
+    Query the nodes of several classes in a single statement.
+
+    The ``UNION ALL`` of the filtered queries of each class (see
+    ``apply_filter_args``) is loaded as :class:`psqlgraph.Node` (each query
+    selects the columns of the polymorphic union of all the node tables,
+    including the type discriminator), so that the ordering, ``first`` and
+    ``offset`` apply to the nodes of all the classes at once. Each query is
+    itself ordered and truncated to ``offset + first`` nodes: no table
+    contributes more nodes than the page can hold. Pages are ordered by
+    node id if no order is requested, after the length of the submitter id
+    with ``quick_search``.
+
+    Args:
+        queries: filtered queries of psqlgraph classes.
+        args: dictionary of the arguments passed to the query.
+        info: graphene object that holds the query's arguments, models and requested fields.
+
+    Returns:
+        psqlgraph.query.GraphQuery: the query of the nodes
+    """
+    node_mapper = sa.inspect(psqlgraph.Node)
+    discriminator = node_mapper.polymorphic_on.name
+    limit = args.get("first", DEFAULT_LIMIT)
+    offset = args.get("offset", 0)
+
+    selects = []
+    for q in queries:
+        cls = q.entity()
+        columns = [
+            (
+                sa.literal(sa.inspect(cls).polymorphic_identity).label(name)
+                if name == discriminator
+                else getattr(cls, name).label(name)
+            )
+            for name in node_mapper.persist_selectable.c.keys()
+        ]
+        # the sort keys of each class, ordered by in the union. The node
+        # id breaks ties so that each query truncated on its own holds the
+        # nodes of the page, and orders the pages if no order is requested
+        sort_keys = []
+        if get_arg_sort_keys(cls, args) or limit > 0 or offset > 0:
+            sort_keys = get_keyset_sort_keys(cls, args)
+            if args.get("quick_search") and not get_arg_sort_keys(cls, args):
+                # the heuristic order of apply_arg_quicksearch
+                _, sub_id_attr = quicksearch.get_search_expressions(cls)
+                sort_keys.insert(0, (sa.func.length(sub_id_attr), sa.asc))
+        columns += [
+            expression.label("sort_{}".format(i))
+            for i, (expression, _) in enumerate(sort_keys)
+        ]
+        q = q.with_entities(*columns)
+        q = q.order_by(*[direction(expression) for expression, direction in sort_keys])
+        if limit > 0:
+            q = q.limit(offset + limit)
+        selects.append(q.subquery().select())
+
+    union = sa.union_all(*selects).subquery()
+    node = sa.orm.aliased(psqlgraph.Node, union, adapt_on_names=True)
+    q = capp.db.nodes(node).order_by(
+        *[
+            direction(union.c["sort_{}".format(i)])
+            for i, (_, direction) in enumerate(sort_keys)
+        ]
+    )
+    q = apply_arg_limit(q, args, info)
+    q = apply_arg_offset(q, args, info)
+    return q
+
+
 def lookup_graphql_type(T):
     # XXX: for now all arrays are assumed to contain string items.
     # graphene.List(graphene.String) should eventually be replaced
@@ -701,12 +1030,10 @@ def get_node_class_link_attrs(cls):
             info,
             name="related_cases",
         )
+        q = apply_props_only(q, info, Node.fields_depend_on_columns)
         qcls = __gql_object_classes["case"]
         try:
-            return [
-                qcls(**load_node(n, info, Node.fields_depend_on_columns))
-                for n in q.all()
-            ]
+            return [qcls(**load_row(row, "case")) for row in iter_query(q)]
         except Exception as e:
             capp.logger.exception(e)
             raise
@@ -748,53 +1075,127 @@ def get_node_class_link_attrs(cls):
     return attrs
 
 
+def filter_link_neighbors(cls, link, parent_ids, args, info):
+    """Query the neighbors through :param:`link` of all the ``cls``
+    nodes in :param:`parent_ids` at once, joined to the edges leading
+    to them.
+
+    Filters are applied as in :func:`apply_query_args`, but ordering,
+    ``first`` and ``offset`` are left to the caller because they apply
+    to the neighbors of each parent separately.
+
+    :returns:
+        A tuple of the query and the edge column holding parent ids.
+
+    """
+
+    target = cls._pg_edges[link]["type"]
+    edge, parent_id_column, neighbor_id_column = get_link_edge(cls, link)
+
+    q = (
+        get_authorized_query(target)
+        .join(edge, neighbor_id_column == target.node_id)
+        .filter(parent_id_column.in_(parent_ids))
+    )
+
+    # Filters: select the matching neighbors once for all parents
+    filter_args = {
+        key: value
+        for key, value in args.items()
+        if key not in ["first", "offset", "order_by_asc", "order_by_desc"]
+    }
+    if filter_args:
+        neighbor_ids = sa.select([neighbor_id_column]).where(
+            parent_id_column.in_(parent_ids)
+        )
+        fq = get_authorized_query(target).filter(target.node_id.in_(neighbor_ids))
+        fq = apply_query_args(fq, dict(filter_args, first=0), info)
+        q = q.filter(
+            target.node_id.in_(fq.with_entities(target.node_id).subquery().select())
+        )
+
+    return q, parent_id_column
+
+
+def query_link_neighbors(cls, link, parent_ids, args, info):
+    """Query the neighbors through :param:`link` of all the ``cls``
+    nodes in :param:`parent_ids` at once.
+
+    ``first`` and ``offset`` are applied for each parent separately
+    with a window function, so each parent gets the same neighbors it
+    would get from a query of its own.
+
+    The neighbors are projected on the properties required for query
+    (see ``get_props_columns``).
+
+    :returns:
+        A query selecting rows of the neighbor columns followed by the
+        parent id.
+
+    """
+
+    target = cls._pg_edges[link]["type"]
+    q, parent_id_column = filter_link_neighbors(cls, link, parent_ids, args, info)
+
+    order_by = get_arg_order_by(target, args)
+    limit = args.get("first", DEFAULT_LIMIT)
+    offset = args.get("offset", 0)
+    if limit <= 0 and offset <= 0:
+        columns = get_props_columns(target, info, Node.fields_depend_on_columns)
+        return q.with_entities(*columns, parent_id_column).order_by(*order_by)
+
+    # first, offset: number the neighbors of each parent
+    rank = sa.func.row_number().over(
+        partition_by=parent_id_column, order_by=order_by or None
+    )
+    sq = q.add_columns(
+        parent_id_column.label("parent_id"), rank.label("rank")
+    ).subquery()
+    neighbor = sa.orm.aliased(target, sq)
+    columns = get_props_columns(neighbor, info, Node.fields_depend_on_columns)
+    q = (
+        capp.db.nodes(neighbor)
+        .with_entities(*columns, sq.c.parent_id)
+        .filter(sq.c.rank > offset)
+    )
+    if limit > 0:
+        q = q.filter(sq.c.rank <= offset + limit)
+    return q.order_by(sq.c.rank)
+
+
+def query_link_neighbor_counts(cls, link, parent_ids, args, info):
+    """Count the neighbors through :param:`link` of all the ``cls``
+    nodes in :param:`parent_ids` in a single ``GROUP BY`` query.
+
+    :returns:
+        A query selecting ``(parent_id, count)`` tuples. Parents
+        without any matching neighbor are absent from the result.
+
+    """
+
+    q, parent_id_column = filter_link_neighbors(cls, link, parent_ids, args, info)
+    return q.with_entities(parent_id_column, sa.func.count()).group_by(parent_id_column)
+
+
 def get_node_class_link_resolver_attrs(cls):
     link_resolver_attrs = {}
     for link_name, link in cls._pg_edges.items():
 
-        def link_query(self, info, cls=cls, link=link, **args):
-            try:
-                target, backref = link["type"], link["backref"]
-                # Subquery for neighor connected to node
-                sq = (
-                    get_authorized_query(target)
-                    .filter(getattr(target, backref).any(node_id=self.id))
-                    .subquery()
-                )
-                q = get_authorized_query(target).filter(target.node_id == sq.c.node_id)
-                q = apply_query_args(q, args, info)
-                return q
-            except Exception as e:
-                capp.logger.exception(e)
-                raise
-
         # Nesting links
-        def resolve_link(self, info, cls=cls, link=link, **args):
-            try:
-                q = link_query(self, info, cls=cls, link=link, **args)
-                qcls = __gql_object_classes[link["type"].label]
-                return [
-                    qcls(**load_node(n, info, Node.fields_depend_on_columns))
-                    for n in q.all()
-                ]
-            except Exception as e:
-                capp.logger.exception(e)
-                raise
+        def resolve_link(self, info, cls=cls, link_name=link_name, link=link, **args):
+            qcls = __gql_object_classes[link["type"].label]
+            loader = LinkLoader.current(cls, link_name, args, info)
+            return loader.load(self.id).then(
+                lambda nodes: [qcls(**node) for node in nodes]
+            )
 
         lr_name = "resolve_{}".format(link_name)
         resolve_link.__name__ = lr_name
         link_resolver_attrs[lr_name] = resolve_link
 
         # Link counts
-        def resolve_link_count(self, info, cls=cls, link=link, **args):
-            try:
-                q = link_query(self, info, cls=cls, link=link, **args)
-                q = q.with_entities(sa.distinct(link["type"].node_id))
-                q = q.limit(None)
-                return clean_count(q)
-            except Exception as e:
-                capp.logger.exception(e)
-                raise
+        def resolve_link_count(self, info, cls=cls, link_name=link_name, **args):
+            return LinkCountLoader.current(cls, link_name, args, info).load(self.id)
 
         lr_count_name = "resolve_{}".format(COUNT_NAME.format(link_name))
         resolve_link_count.__name__ = lr_count_name
@@ -803,6 +1204,13 @@ def get_node_class_link_resolver_attrs(cls):
         # Arbitrary link
         def resolve_links(self, info, cls=cls, **args):
             try:
+                if capp.node_index and capp.node_index.is_ready():
+                    return [
+                        __gql_object_classes[n.label](
+                            **load_node(n, info, Node.fields_depend_on_columns)
+                        )
+                        for n in query_indexed_neighbors(self.id, args, info)
+                    ]
                 edge_out_sq = (
                     capp.db.edges().filter(psqlgraph.Edge.src_id == self.id).subquery()
                 )
@@ -823,7 +1231,7 @@ def get_node_class_link_resolver_attrs(cls):
                     __gql_object_classes[n.label](
                         **load_node(n, info, Node.fields_depend_on_columns)
                     )
-                    for n in q.all()
+                    for n in iter_query(q)
                 ]
             except Exception as e:
                 capp.logger.exception(e)
@@ -859,8 +1267,10 @@ class NodeCounter:
     """SQL builder for specific count queries.
 
     With large dictionary of hundreds of nodes, constructing count queries can be a time
-    consuming task with SQLAlchemy. This workaround uses raw SQL and combines all simple
-    count queries into one to reduce query build time and round-trip time to database.
+    consuming task with SQLAlchemy. This workaround uses raw SQL for simple count
+    queries (filtered on ``project_id`` only), and compiles the other count queries into
+    scalar subqueries; all of them are combined into one statement to reduce query build
+    time and round-trip time to database.
     """
 
     def __init__(self):
@@ -873,7 +1283,13 @@ class NodeCounter:
             flask.g.node_counter = cls()
         return flask.g.node_counter
 
-    def add_count(self, cls, args):
+    @staticmethod
+    def get_project_id(cls, args):
+        """Return the project_id of a simple count query, or None if the
+        count query is not simple.
+
+        """
+
         # escape non-trivial cases defined in `authorization_filter`
         if cls != psqlgraph.Node and not hasattr(cls, "project_id"):
             return None
@@ -883,46 +1299,287 @@ class NodeCounter:
         if list(args.keys()) != ["project_id"]:
             return None
 
-        # extract project_id and guarantee permission
         project_id = args["project_id"]
         if isinstance(project_id, (list, tuple)) and len(project_id) == 1:
             project_id = project_id[0]
         if not isinstance(project_id, str):
             # escape if multiple project_ids are given
             return None
-        if project_id not in flask.g.read_access_projects:
+        return project_id
+
+    def add_count(self, cls, args, info=None):
+        project_id = self.get_project_id(cls, args)
+        if project_id is None:
+            count = clean_count_statement(get_count_query(cls, args, info))
+        elif project_id not in flask.g.read_access_projects:
+            # guarantee permission
             return 0
-
-        # group project_id and name them
-        project_id_name = self._project_ids.get(project_id, None)
-        if project_id_name is None:
-            project_id_name = "p_%s" % len(self._project_ids)
-            self._project_ids[project_id] = project_id_name
+        else:
+            # group project_id and name them
+            project_id_name = self._project_ids.get(project_id, None)
+            if project_id_name is None:
+                project_id_name = "p_%s" % len(self._project_ids)
+                self._project_ids[project_id] = project_id_name
+            count = (
+                sa.select([sa.func.count()])
+                .select_from(sa.table(cls.__tablename__))
+                .where(sa.text("_props->>'project_id' = :%s" % project_id_name))
+            )
 
         # prepare the subquery and promise
         key = "c_%s" % len(self._queries)
         p = Promise()
-        self._queries.append(
-            (
-                key,
-                p,
-                "(SELECT count(*) FROM %s WHERE _props->>'project_id' = :%s) AS %s"
-                % (cls.__tablename__, project_id_name, key),
-            )
-        )
+        self._queries.append((key, p, count.scalar_subquery()))
         return p
 
     def run(self, session):
         if not self._queries:
             return
 
-        sql = "SELECT %s;" % ", ".join(count for _, _, count in self._queries)
-        results = session.execute(
-            sql, dict((v, k) for k, v in self._project_ids.items())
-        ).fetchone()
+        params = dict((v, k) for k, v in self._project_ids.items())
+        several = len(self._queries) > 1
+        try:
+            results = self.execute(session, self._queries, params, savepoint=several)
+        except Exception as e:
+            if not several or is_query_canceled(e):
+                # the counts would time out again one by one
+                capp.logger.exception(e)
+                for _, promise, _ in self._queries:
+                    promise.do_reject(e)
+                return
+            # run the counts one by one, so that only the fields whose count
+            # failed get an error
+            capp.logger.warning("Running the counts one by one: {}".format(e))
+            for query in self._queries:
+                key, promise, _ = query
+                try:
+                    result = self.execute(session, [query], params, savepoint=True)
+                except Exception as e:
+                    capp.logger.exception(e)
+                    promise.do_reject(e)
+                else:
+                    promise.fulfill(result[key])
+            return
         for key, promise, _ in self._queries:
             promise.fulfill(results[key])
 
+    @staticmethod
+    def execute(session, queries, params, savepoint=False):
+        """Select the counts of :param:`queries` in one statement, in a
+        savepoint if :param:`savepoint` is set, so that the transaction can
+        go on if it fails."""
+        statement = sa.select([count.label(key) for key, _, count in queries])
+        if not savepoint:
+            return session.execute(statement, params).fetchone()
+        with session.begin_nested():
+            return session.execute(statement, params).fetchone()
+
+
+class LinkLoader(DataLoader):
+    """Batch loader for the neighbors through one link.
+
+    Resolving a link field issues one query per parent node, which adds
+    up to thousands of round trips for nested queries. Instead, link
+    resolvers ask the loader for a parent id and get a promise back;
+    all the ids requested at one level of the tree are then fetched in
+    one query (see :func:`query_link_neighbors`). There is one loader
+    per request for each link, set of arguments and set of properties
+    required for query.
+    """
+
+    def __init__(self, cls, link, args, info):
+        super(LinkLoader, self).__init__()
+        self.cls = cls
+        self.link = link
+        self.args = args
+        self.info = info
+
+    @classmethod
+    def current(cls, node_cls, link, args, info):
+        if not hasattr(flask.g, "link_loaders"):
+            flask.g.link_loaders = {}
+        key = (
+            cls,
+            node_cls,
+            link,
+            json.dumps(args, sort_keys=True, default=str),
+            cls.get_selection(node_cls, link, info),
+        )
+        if key not in flask.g.link_loaders:
+            flask.g.link_loaders[key] = cls(node_cls, link, args, info)
+        return flask.g.link_loaders[key]
+
+    @staticmethod
+    def get_selection(node_cls, link, info):
+        """The properties of the neighbors required for query"""
+        target = node_cls._pg_edges[link]["type"]
+        return frozenset(
+            get_loaded_columns(target, info, Node.fields_depend_on_columns)
+        )
+
+    def batch_load_fn(self, parent_ids):
+        label = self.cls._pg_edges[self.link]["type"].label
+        try:
+            q = query_link_neighbors(
+                self.cls, self.link, parent_ids, self.args, self.info
+            )
+            neighbors = {parent_id: [] for parent_id in parent_ids}
+            for row in q.all():
+                node = dict(zip(row._fields[:-1], row[:-1]), type=label)
+                neighbors[row[-1]].append(node)
+        except Exception as e:
+            capp.logger.exception(e)
+            raise
+        return Promise.resolve([neighbors[parent_id] for parent_id in parent_ids])
+
+
+class LinkCountLoader(LinkLoader):
+    """Batch loader for the number of neighbors through one link, see
+    :class:`LinkLoader`.
+    """
+
+    @staticmethod
+    def get_selection(node_cls, link, info):
+        return None
+
+    def batch_load_fn(self, parent_ids):
+        try:
+            q = query_link_neighbor_counts(
+                self.cls, self.link, parent_ids, self.args, self.info
+            )
+            counts = dict(q.all())
+        except Exception as e:
+            capp.logger.exception(e)
+            raise
+        return Promise.resolve([counts.get(parent_id, 0) for parent_id in parent_ids])
+
+
+def get_count_query(cls, args, info):
+    """Return the query whose results the ``_<node>_count`` field counts"""
+
+    q = get_authorized_query(cls)
+    q = apply_query_args(q, args, info)
+    if "with_path_to" in args or "with_path_to_any" in args:
+        q = q.with_entities(sa.distinct(cls.node_id))
+    return q.limit(args.get("first", None))
+
+
+class PageInfo(graphene.ObjectType):
+    """Position of the last node of a page, to query the next page with
+    ``after: end_cursor``"""
+
+    end_cursor = graphene.String()
+    has_next_page = graphene.Boolean()
+
+
+class PageLoader(DataLoader):
+    """Batch loader for the page of nodes selected by the arguments of a
+    root field, and for its ``PageInfo``.
+
+    The root field and the ``_<node>_page_info`` field with the same
+    arguments ask the same loader, so that one query returns both: the
+    query fetches one node more than the page to tell if there is a next
+    page, and the sort keys of the nodes to build the end cursor. Without
+    the page info field, the query of the root field is left as is.
+
+    The keys are the ``info`` of the root fields, which select the
+    properties of the nodes, and ``PAGE_INFO``.
+    """
+
+    PAGE_INFO = "page_info"
+
+    def __init__(self, cls, args, info):
+        super(PageLoader, self).__init__()
+        self.cls = cls
+        self.args = args
+        self.info = info
+
+    @classmethod
+    def current(cls, node_cls, args, info):
+        if not hasattr(flask.g, "page_loaders"):
+            flask.g.page_loaders = {}
+        key = (node_cls, json.dumps(args, sort_keys=True, default=str))
+        if key not in flask.g.page_loaders:
+            flask.g.page_loaders[key] = cls(node_cls, args, info)
+        return flask.g.page_loaders[key]
+
+    def batch_load_fn(self, keys):
+        try:
+            return Promise.resolve(self.load_page(keys))
+        except Exception as e:
+            capp.logger.exception(e)
+            raise
+
+    def load_page(self, keys):
+        cls, args = self.cls, self.args
+        page_info = self.PAGE_INFO in keys
+        if page_info and not get_arg_sort_keys(cls, args) and not args.get("after"):
+            # without an order, the nodes of the next page are undefined
+            raise RuntimeError(
+                "{} requires order_by_asc or order_by_desc on the first page".format(
+                    PAGE_INFO_NAME.format(cls.label)
+                )
+            )
+
+        # the properties required by any of the root fields
+        columns = {}
+        for info in keys:
+            if info is not self.PAGE_INFO:
+                for column in get_props_columns(
+                    cls, info, Node.fields_depend_on_columns
+                ):
+                    columns[column.name] = column
+
+        q = get_authorized_query(cls)
+        first = args.get("first", DEFAULT_LIMIT)
+        if page_info:
+            # one more node tells if there is a next page
+            q = apply_query_args(
+                q, dict(args, first=first + 1 if first > 0 else 0), self.info, True
+            )
+            cursor_columns = [
+                column.label("_cursor_{}".format(i))
+                for i, column in enumerate(get_cursor_columns(cls, args))
+            ]
+        else:
+            q = apply_query_args(q, args, self.info)
+            cursor_columns = []
+        q = q.with_entities(*(list(columns.values()) + cursor_columns))
+
+        nodes = []
+        cursors = []
+        for row in iter_query(q):
+            node = load_row(row, cls.label)
+            cursors.append([node.pop(column.name) for column in cursor_columns])
+            nodes.append(node)
+        has_next_page = page_info and 0 < first < len(nodes)
+        if has_next_page:
+            nodes = nodes[:first]
+            cursors = cursors[:first]
+
+        page = PageInfo(
+            end_cursor=encode_cursor(cursors[-1]) if cursors else args.get("after"),
+            has_next_page=has_next_page,
+        )
+        return [page if key is self.PAGE_INFO else nodes for key in keys]
+
+
+def resolve_page_info(cls, args, info):
+    """Return the ``PageInfo`` of the page selected by :param:`args`,
+    from the query of the page (see :class:`PageLoader`)."""
+    return PageLoader.current(cls, args, info).load(PageLoader.PAGE_INFO)
+
+
+def iter_root_nodes(q, gql_object, label):
+    """Yield the graphene objects of the rows selected by :param:`q`
+    (see ``stream.py``)"""
+    try:
+        for row in iter_query(q):
+            yield gql_object(**load_row(row, label))
+    except Exception as e:
+        capp.logger.exception(e)
+        raise
+
 
 def create_root_fields(fields):
     attrs = {}
@@ -931,18 +1588,20 @@ def create_root_fields(fields):
 
         # Object resolver
         def resolver(self, info, cls=cls, gql_object=gql_object, **args):
-            q = get_authorized_query(cls)
-            q = apply_query_args(q, args, info)
-            try:
-                return [
-                    gql_object(**load_node(n, info, Node.fields_depend_on_columns))
-                    for n in q.all()
-                ]
-            except Exception as e:
-                capp.logger.exception(e)
-                raise
+            if (info.context or {}).get("stream"):
+                q = get_authorized_query(cls)
+                q = apply_query_args(q, args, info)
+                q = apply_props_only(q, info, Node.fields_depend_on_columns)
+                return iter_root_nodes(q, gql_object, cls.label)
+            # the page info field with the same arguments uses the same query
+            return (
+                PageLoader.current(cls, args, info)
+                .load(info)
+                .then(lambda nodes: [gql_object(**node) for node in nodes])
+            )
 
-        field = graphene.Field(graphene.List(gql_object), args=get_node_class_args(cls))
+        root_args = dict(get_node_class_args(cls), after=graphene.String())
+        field = graphene.Field(graphene.List(gql_object), args=root_args)
 
         res_name = "resolve_{}".format(name)
         resolver.__name__ = res_name
@@ -951,16 +1610,7 @@ def create_root_fields(fields):
 
         # Count resolver
         def count_resolver(self, info, cls=cls, gql_object=gql_object, **args):
-            rv = NodeCounter.current().add_count(cls, args)
-            if rv is not None:
-                return rv
-
-            q = get_authorized_query(cls)
-            q = apply_query_args(q, args, info)
-            if "with_path_to" in args or "with_path_to_any" in args:
-                q = q.with_entities(sa.distinct(cls.node_id))
-            q = q.limit(args.get("first", None))
-            return clean_count(q)
+            return NodeCounter.current().add_count(cls, args, info)
 
         count_field = graphene.Field(graphene.Int, args=get_node_class_args(cls))
         count_name = COUNT_NAME.format(name)
@@ -969,6 +1619,21 @@ def create_root_fields(fields):
         attrs[count_name] = count_field
         attrs[count_res_name] = count_resolver
 
+        # Page info resolver
+        def page_info_resolver(self, info, cls=cls, **args):
+            try:
+                return resolve_page_info(cls, args, info)
+            except Exception as e:
+                capp.logger.exception(e)
+                raise
+
+        page_info_field = graphene.Field(PageInfo, args=root_args)
+        page_info_name = PAGE_INFO_NAME.format(name)
+        page_info_res_name = "resolve_{}".format(page_info_name)
+        page_info_resolver.__name__ = page_info_res_name
+        attrs[page_info_name] = page_info_field
+        attrs[page_info_res_name] = page_info_resolver
+
     return attrs
 
 
@@ -1064,11 +1729,8 @@ def resolve_datanode(self, info, **args):
     """
     The root query for the :class:`DataNode` node interface.
 
-    NOTE: A limitation of `datanode` is that the `first` and `offset` filters are not applied
-    properly. Example: If there are 4 file nodes, a `datanode` query with limit=10 returns up
-    to 4*10 = 40 items. `query_with_args()` concatenates the results of all file node queries
-    _after_ the filters are applied by `apply_query_args()`. Applying limits/offsets at the end
-    of `query_with_args()` causes inconsistent and incomplete results.
+    The `first` and `offset` filters apply to the nodes of all the data
+    classes at once (see `query_union`).
 
     :returns:
         A list of graphene object classes.
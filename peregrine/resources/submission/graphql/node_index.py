@@ -0,0 +1,220 @@
+"""
+Global index of the nodes: a table mapping the id of every node to its
+label, project id and submitter id. Queries on the ``psqlgraph.Node`` base
+filtering by id or submitter id (e.g. ``node(id: ...)``, ``_links``) look
+up the labels of the matching nodes in the index and then query only the
+tables of these labels, instead of scanning every node table.
+
+The index is built by ``bin/rebuild_node_index.py``, which also installs
+triggers keeping it up to date on the node tables. The index is not used
+unless every node table of the dictionary has these triggers.
+"""
+
+import threading
+import time
+
+from cdislogging import get_logger
+from psqlgraph import Node
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+logger = get_logger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+metadata = sa.MetaData()
+
+node_index = sa.Table(
+    "_node_index",
+    metadata,
+    sa.Column("node_id", sa.Text, primary_key=True),
+    sa.Column("label", sa.Text, nullable=False),
+    sa.Column("project_id", sa.Text),
+    sa.Column("submitter_id", sa.Text),
+    sa.Index("_node_index_submitter_id_idx", "submitter_id"),
+)
+
+node_index_state = sa.Table(
+    "_node_index_state",
+    metadata,
+    sa.Column("node_tables", ARRAY(sa.Text), nullable=False),
+    sa.Column("built", sa.DateTime, nullable=False),
+)
+
+UPDATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION _update_node_index() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM _node_index WHERE label = TG_ARGV[0];
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM _node_index WHERE node_id = OLD.node_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO _node_index (node_id, label, project_id, submitter_id)
+        VALUES (
+            NEW.node_id,
+            TG_ARGV[0],
+            NEW._props->>'project_id',
+            NEW._props->>'submitter_id'
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+ROW_TRIGGER = "_node_index_row"
+TRUNCATE_TRIGGER = "_node_index_truncate"
+
+
+def create_tables(engine):
+    metadata.create_all(engine)
+    engine.execute(UPDATE_FUNCTION)
+
+
+def drop_tables(engine):
+    """Drop the index and the triggers keeping it up to date"""
+    engine.execute("DROP FUNCTION IF EXISTS _update_node_index() CASCADE")
+    metadata.drop_all(engine)
+
+
+def rebuild(db):
+    """
+    Rebuild the index of all the nodes and install the triggers keeping it
+    up to date, in a single transaction.
+
+    Args:
+        db (psqlgraph.PsqlGraphDriver): database driver
+
+    Returns:
+        int: number of nodes in the index
+    """
+    classes = Node.get_subclasses()
+    with db.engine.begin() as conn:
+        # install the triggers first: nodes written during the rebuild are
+        # indexed either by the triggers or by the rebuild
+        for cls in classes:
+            for trigger, event in [
+                (ROW_TRIGGER, "INSERT OR UPDATE OR DELETE ON {table} FOR EACH ROW"),
+                (TRUNCATE_TRIGGER, "TRUNCATE ON {table} FOR EACH STATEMENT"),
+            ]:
+                table = '"{}"'.format(cls.__tablename__)
+                conn.execute("DROP TRIGGER IF EXISTS {} ON {}".format(trigger, table))
+                conn.execute(
+                    "CREATE TRIGGER {} AFTER {} EXECUTE PROCEDURE "
+                    "_update_node_index('{}')".format(
+                        trigger, event.format(table=table), cls.label
+                    )
+                )
+
+        conn.execute(node_index.delete())
+        for cls in classes:
+            conn.execute(
+                insert(node_index)
+                .from_select(
+                    ["node_id", "label", "project_id", "submitter_id"],
+                    sa.select(
+                        cls.node_id,
+                        sa.literal(cls.label),
+                        cls._props["project_id"].astext,
+                        cls._props["submitter_id"].astext,
+                    ),
+                )
+                .on_conflict_do_nothing()
+            )
+
+        conn.execute(node_index_state.delete())
+        conn.execute(
+            node_index_state.insert().values(
+                node_tables=sorted(cls.__tablename__ for cls in classes),
+                built=sa.func.now(),
+            )
+        )
+        return conn.execute(sa.select(sa.func.count()).select_from(node_index)).scalar()
+
+
+def get_triggered_tables(conn, trigger):
+    """Return the names of the tables on which :param:`trigger` is
+    installed and enabled"""
+    return {
+        table
+        for (table,) in conn.execute(
+            sa.text(
+                "SELECT c.relname FROM pg_trigger t "
+                "JOIN pg_class c ON c.oid = t.tgrelid "
+                "WHERE t.tgname = :trigger AND t.tgenabled <> 'D'"
+            ),
+            {"trigger": trigger},
+        )
+    }
+
+
+class NodeIndex(object):
+    """
+    Lookups in the node index, if it is built for all the node tables and
+    their triggers are installed (checked again when older than the refresh
+    interval).
+    """
+
+    def __init__(self, db, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        Args:
+            db (psqlgraph.PsqlGraphDriver): database driver
+            refresh_interval (float): seconds before the index state is
+                checked again
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._ready = False
+
+    def invalidate(self):
+        """Check the index state on its next use"""
+        self._loaded_at = None
+
+    def load(self):
+        ready = False
+        if sa.inspect(self.db.engine).has_table(node_index_state.name):
+            with self.db.engine.connect() as conn:
+                indexed_tables = set()
+                for (node_tables,) in conn.execute(
+                    sa.select(node_index_state.c.node_tables)
+                ):
+                    indexed_tables.update(node_tables)
+                # without the triggers, the index misses the later writes
+                for trigger in [ROW_TRIGGER, TRUNCATE_TRIGGER]:
+                    indexed_tables &= get_triggered_tables(conn, trigger)
+            node_tables = {cls.__tablename__ for cls in Node.get_subclasses()}
+            ready = node_tables.issubset(indexed_tables)
+        self._ready = ready
+        self._loaded_at = time.time()
+
+    def is_ready(self):
+        """Return True if the index can be used"""
+        with self._lock:
+            if (
+                self._loaded_at is None
+                or time.time() - self._loaded_at > self.refresh_interval
+            ):
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.warning("Unable to load the node index state: %s", e)
+                    self._ready = False
+                    self._loaded_at = time.time()
+            return self._ready
+
+    def get_labels(self, session, node_ids=None, submitter_ids=None):
+        """
+        Return the labels of the nodes with an id in :param:`node_ids` and
+        a submitter id in :param:`submitter_ids` (None: any).
+        """
+        q = sa.select(node_index.c.label).distinct()
+        if node_ids is not None:
+            q = q.where(node_index.c.node_id.in_(node_ids))
+        if submitter_ids is not None:
+            q = q.where(node_index.c.submitter_id.in_(submitter_ids))
+        return {label for (label,) in session.execute(q)}
@@ -0,0 +1,77 @@
+"""
+Trigram indexes for the ``quick_search`` filter, which searches for
+substrings of the node ids and submitter ids (``LIKE '%...%'``). A B-tree
+index cannot answer such a search, but a ``pg_trgm`` GIN index on the same
+expression can: the filter (see ``node.apply_arg_quicksearch``) searches
+the expressions of :func:`get_search_expressions`, which are the indexed
+expressions, so the planner uses the indexes of the tables where
+``bin/create_quicksearch_indexes.py`` created them. Elsewhere, the tables
+are scanned.
+"""
+
+from psqlgraph import Node
+import sqlalchemy as sa
+
+# the indexed expressions of the columns searched by quick_search, by name
+INDEXED_EXPRESSIONS = {
+    "node_id": "lower(node_id)",
+    "submitter_id": "lower(_props ->> 'submitter_id')",
+}
+
+
+def get_search_expressions(cls):
+    """Return the expressions of the node id and submitter id searched by
+    quick_search, in the order of ``INDEXED_EXPRESSIONS``"""
+    return [
+        sa.func.lower(cls.node_id),
+        sa.func.lower(cls._props["submitter_id"].astext),
+    ]
+
+
+def get_index_name(table, name):
+    return "{}_{}_trgm_idx".format(table, name)
+
+
+def create_indexes(engine, concurrently=True):
+    """
+    Create the trigram indexes of every node table (and the ``pg_trgm``
+    extension, which requires the privilege to create it).
+
+    Args:
+        engine (sqlalchemy.engine.Engine): database engine
+        concurrently (bool): do not lock the tables against writes while
+            the indexes are built
+
+    Returns:
+        list: names of the indexes
+    """
+    indexes = []
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for cls in Node.get_subclasses():
+            for name, expression in INDEXED_EXPRESSIONS.items():
+                index = get_index_name(cls.__tablename__, name)
+                conn.execute(
+                    'CREATE INDEX {}IF NOT EXISTS "{}" ON "{}" '
+                    "USING gin (({}) gin_trgm_ops)".format(
+                        "CONCURRENTLY " if concurrently else "",
+                        index,
+                        cls.__tablename__,
+                        expression,
+                    )
+                )
+                indexes.append(index)
+    return indexes
+
+
+def drop_indexes(engine):
+    """Drop the trigram indexes of every node table"""
+    with engine.begin() as conn:
+        for cls in Node.get_subclasses():
+            for name in INDEXED_EXPRESSIONS:
+                conn.execute(
+                    'DROP INDEX IF EXISTS "{}"'.format(
+                        get_index_name(cls.__tablename__, name)
+                    )
+                )
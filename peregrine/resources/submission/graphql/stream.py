@@ -0,0 +1,182 @@
+"""
+Streaming execution of GraphQL queries: the result is written as
+newline-delimited JSON while the nodes of the top-level list fields are
+fetched from a server-side cursor, so the memory used by a query does not
+depend on the size of its result.
+
+Each line holds one node of a top-level list field, e.g.
+``{"case": {"id": ...}}``, or the value of another top-level field, e.g.
+``{"_case_count": 10}``. A list field without nodes has no line. If errors
+occurred, the last line is ``{"errors": [...]}``.
+"""
+
+import json
+
+import flask
+from graphql.error import GraphQLError
+from graphql.execution.executor import (
+    complete_value_catching_error,
+    resolve_field,
+    resolve_or_error,
+)
+from graphql.execution.executors.sync import SyncExecutor
+from graphql.execution.base import ResolveInfo
+from graphql.execution.utils import (
+    ExecutionContext,
+    collect_fields,
+    default_resolve_fn,
+    get_field_def,
+    get_operation_root_type,
+)
+from graphql.pyutils.default_ordered_dict import DefaultOrderedDict
+from graphql.type import GraphQLList
+from promise import is_thenable
+
+from peregrine.utils.pyutils import log_duration
+from .backend import parse_query
+from .node import NodeCounter
+from .util import STREAM_BATCH_SIZE, set_session_timeout
+
+
+def iter_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def wait_for(value, session):
+    """Run the pending count queries and return the value of a promise"""
+    NodeCounter.current().run(session)
+    return value.get() if is_thenable(value) else value
+
+
+def reset_request_loaders():
+    """Drop the count queries, link loaders and page loaders (and the nodes
+    they cache) of the previous batch"""
+    flask.g.pop("node_counter", None)
+    flask.g.pop("link_loaders", None)
+    flask.g.pop("page_loaders", None)
+
+
+def stream_query(query, variables=None, app=None, timeout=None):
+    """
+    Parse and validate a query, and return a generator executing it.
+
+    Root list fields are resolved with ``info.context["stream"]`` set, so
+    that they return an iterator over the nodes instead of a list. The
+    nodes are completed (nested fields resolved) in batches of
+    ``STREAM_BATCH_SIZE``.
+
+    :param timeout: statement timeout in seconds
+    :returns: a tuple (``lines``, ``errors``): the generator of the lines
+        of the result, or None and the errors preventing the execution
+    """
+    variables = variables or {}
+    if app is None:
+        app = flask.current_app
+    schema = app.graphql_schema
+    try:
+        document_ast, validation_errors = parse_query(
+            query, schema, getattr(app, "graphql_backend", None)
+        )
+        if validation_errors:
+            return None, [error.message for error in validation_errors]
+        exe_context = ExecutionContext(
+            schema,
+            document_ast,
+            root_value=None,
+            context_value={"stream": True},
+            variable_values=variables,
+            operation_name=None,
+            executor=SyncExecutor(),
+            middleware=None,
+            allow_subscriptions=False,
+        )
+    except GraphQLError as e:
+        return None, [str(e)]
+    return execute_stream(app, exe_context, query, variables, timeout), None
+
+
+def execute_stream(app, exe_context, query, variables, timeout=None):
+    root_type = get_operation_root_type(exe_context.schema, exe_context.operation)
+    fields = collect_fields(
+        exe_context,
+        root_type,
+        exe_context.operation.selection_set,
+        DefaultOrderedDict(list),
+        set(),
+    )
+    timer = log_duration(f"GraphQL stream: {query}, variables: {variables}")
+    with app.db.session_scope() as session, timer:
+        if timeout:
+            set_session_timeout(session, timeout)
+        for response_name, field_asts in fields.items():
+            reset_request_loaders()
+            field_def = get_field_def(
+                exe_context.schema, root_type, field_asts[0].name.value
+            )
+            if not isinstance(field_def.type, GraphQLList):
+                value = resolve_field(
+                    exe_context, root_type, None, field_asts, None, [response_name]
+                )
+                yield json.dumps({response_name: wait_for(value, session)}) + "\n"
+                continue
+            for line in stream_list_field(
+                exe_context, root_type, response_name, field_asts, field_def, session
+            ):
+                yield line
+
+    if exe_context.errors:
+        errors = [
+            err.message if hasattr(err, "message") else str(err)
+            for err in exe_context.errors
+        ]
+        yield json.dumps({"errors": errors}) + "\n"
+
+
+def stream_list_field(
+    exe_context, root_type, response_name, field_asts, field_def, session
+):
+    """Yield a line per item of a root list field (see ``resolve_field``)"""
+    info = ResolveInfo(
+        field_asts[0].name.value,
+        field_asts,
+        field_def.type,
+        root_type,
+        schema=exe_context.schema,
+        fragments=exe_context.fragments,
+        root_value=exe_context.root_value,
+        operation=exe_context.operation,
+        variable_values=exe_context.variable_values,
+        context=exe_context.context_value,
+        path=[response_name],
+    )
+    resolve_fn = exe_context.get_field_resolver(
+        field_def.resolver or default_resolve_fn
+    )
+    args = exe_context.get_argument_values(field_def, field_asts[0])
+    items = resolve_or_error(resolve_fn, None, info, args, exe_context.executor)
+    if isinstance(items, Exception) or items is None:
+        # report the error
+        complete_value_catching_error(
+            exe_context, field_def.type, field_asts, info, [response_name], items
+        )
+        yield json.dumps({response_name: None}) + "\n"
+        return
+
+    try:
+        for batch in iter_batches(items, STREAM_BATCH_SIZE):
+            reset_request_loaders()
+            completed = complete_value_catching_error(
+                exe_context, field_def.type, field_asts, info, [response_name], batch
+            )
+            for item in wait_for(completed, session) or []:
+                yield json.dumps({response_name: item}) + "\n"
+    except Exception as e:
+        # errors raised while fetching the nodes
+        exe_context.report_error(e)
@@ -8,10 +8,16 @@ execute those traversal queries in the database
 """
 
 import flask
+import gzip
+import hashlib
+import json
+import os
 from psqlgraph import Node, Edge
 import sqlalchemy as sa
 import time
 
+from peregrine import dictionary
+
 terminal_nodes = [
     "annotations",
     "centers",
@@ -54,10 +60,21 @@ def is_valid_direction(node, visited):
         A boolean stating whether the direction we are traveling
         is valid.
     """
+    return is_valid_level(
+        get_category_level(visited[0]),
+        get_category_level(visited[-1]),
+        get_category_level(node),
+    )
+
+
+def get_category_level(node):
     max_level = max(CATEGORY_LEVEL.values()) + 1
-    first_level = CATEGORY_LEVEL.get(visited[0]._dictionary["category"], max_level)
-    last_level = CATEGORY_LEVEL.get(visited[-1]._dictionary["category"], max_level)
-    this_level = CATEGORY_LEVEL.get(node._dictionary["category"], max_level)
+    return CATEGORY_LEVEL.get(node._dictionary["category"], max_level)
+
+
+def is_valid_level(first_level, last_level, this_level):
+    """See :func:`is_valid_direction`: only the levels of the first and
+    last nodes of the path so far matter."""
     if first_level > last_level:
         # If we are traveling from case out
         return this_level <= last_level
@@ -66,46 +83,92 @@ def is_valid_direction(node, visited):
         return this_level >= last_level
 
 
+def get_traversal_graph(app):
+    """Return the graph of node types used to look for traversals,
+    computed once per app:
+
+    - the list of Node subclasses
+    - the category level of each of them
+    - for each of them, the list of its ``(neighbor index, link name)``
+
+    Nodes are referred to by their index in the list.
+    """
+    graph = getattr(app, "traversal_graph", None)
+    if graph is None:
+        nodes = sorted(Node.get_subclasses(), key=lambda node: node.__name__)
+        index = {node.__name__: i for i, node in enumerate(nodes)}
+        levels = [get_category_level(node) for node in nodes]
+        neighbors = []
+        for node in nodes:
+            links = {
+                (index[edge.__dst_class__], edge.__src_dst_assoc__)
+                for edge in Edge._get_edges_with_src(node.__name__)
+            }
+            links.update(
+                (index[edge.__src_class__], edge.__dst_src_assoc__)
+                for edge in Edge._get_edges_with_dst(node.__name__)
+            )
+            neighbors.append(sorted(links))
+        graph = app.traversal_graph = (nodes, levels, neighbors)
+    return graph
+
+
 def construct_traversals_from_node(root_node, app):
-    traversals = {node.label: set() for node in Node.get_subclasses()}
-    to_visit = [(root_node, [], [])]
-    path = []
+    """Find the paths from :param:`root_node` to every other node type.
+
+    Paths do not go through a node type twice, go in a single direction
+    (see :func:`is_valid_direction`) and stop at terminal links. The
+    ``TRAVERSAL_MAX_PATH_LENGTH`` setting limits the number of links in
+    a path, and with ``TRAVERSAL_SHORTEST_K`` only the k shortest paths
+    to each node type are kept.
+
+    :returns: a dict of node type label to list of paths, e.g.
+        ``{"aliquot": ["samples.aliquots", ...], ...}``
+    """
+    nodes, levels, neighbors = get_traversal_graph(app)
+    max_length = app.config.get("TRAVERSAL_MAX_PATH_LENGTH")
+    shortest_k = app.config.get("TRAVERSAL_SHORTEST_K")
+    root = nodes.index(root_node)
+    traversals = [set() for _ in nodes]
+
+    # Paths are represented by their last node, their string (which shares
+    # the prefix of the parent path's string), their length, the node before
+    # the last one and a bitmask of the nodes before the last one.
+    to_visit = [(root, "", 0, root, 0)]
     while to_visit:
-        node, path, visited = to_visit.pop()
-        if path:
-            path_string = ".".join(path)
-            if path_string in traversals[node.label]:
+        node, path, length, previous, visited = to_visit.pop()
+        if length:
+            if path in traversals[node]:
                 continue
-            traversals[node.label].add(path_string)
+            traversals[node].add(path)
             # stop at terminal nodes
-            if path[-1] in terminal_nodes:
+            if path.rpartition(".")[2] in terminal_nodes:
                 continue
         # Don't walk back up the tree
-        if not is_valid_direction(node, visited or [root_node]):
+        if not is_valid_level(levels[root], levels[previous], levels[node]):
             continue
-        name_to_subclass = getattr(app, "name_to_subclass", None)
-        if name_to_subclass is None:
-            name_to_subclass = app.name_to_subclass = {
-                n.__name__: n for n in Node.get_subclasses()
-            }
-        neighbors_dst = {
-            (name_to_subclass[edge.__dst_class__], edge.__src_dst_assoc__)
-            for edge in Edge._get_edges_with_src(node.__name__)
-            if name_to_subclass[edge.__dst_class__]
-        }
-        neighbors_src = {
-            (name_to_subclass[edge.__src_class__], edge.__dst_src_assoc__)
-            for edge in Edge._get_edges_with_dst(node.__name__)
-            if name_to_subclass[edge.__src_class__]
-        }
+        if max_length and length >= max_length:
+            continue
+        next_visited = visited | 1 << node
         to_visit.extend(
-            [
-                (neighbor, path + [edge], visited + [node])
-                for neighbor, edge in neighbors_dst.union(neighbors_src)
-                if neighbor not in visited
-            ]
+            (
+                neighbor,
+                path + "." + link if length else link,
+                length + 1,
+                node,
+                next_visited,
+            )
+            for neighbor, link in neighbors[node]
+            if not visited >> neighbor & 1
         )
-    return {label: list(paths) for label, paths in traversals.items() if paths}
+
+    result = {}
+    for node, paths in zip(nodes, traversals):
+        if paths:
+            if shortest_k:
+                paths = sorted(paths, key=lambda p: (p.count("."), p))[:shortest_k]
+            result[node.label] = list(paths)
+    return result
 
 
 def make_graph_traversal_dict(app, preload=False):
@@ -115,13 +178,68 @@ def make_graph_traversal_dict(app, preload=False):
     or it will be initialized as an empty dict.
 
     You may call this method with `preload=True` to manually preload the full dict.
+
+    If TRAVERSALS_DIR is set, the full dict is loaded from the file generated
+    for the current dictionary in that directory (see
+    ``bin/generate_traversals.py``). If there is none, the full dict is
+    computed and saved there for the next start.
     """
     app.graph_traversals = getattr(app, "graph_traversals", {})
-    if preload or not app.config.get("USE_LAZY_TRAVERSE", True):
+    traversals_dir = app.config.get("TRAVERSALS_DIR")
+    if traversals_dir:
+        traversals_file = os.path.join(traversals_dir, get_traversals_file_name(app))
+        if os.path.isfile(traversals_file):
+            app.logger.info("Loading graph traversals from %s", traversals_file)
+            app.graph_traversals.update(load_graph_traversals(traversals_file))
+            return
+        for node in Node.get_subclasses():
+            _get_paths_from(node, app)
+        app.logger.info("Saving graph traversals to %s", traversals_file)
+        save_graph_traversals(app.graph_traversals, traversals_file)
+    elif preload or not app.config.get("USE_LAZY_TRAVERSE", True):
         for node in Node.get_subclasses():
             _get_paths_from(node, app)
 
 
+def get_traversals_file_name(app):
+    """
+    Return the name of the graph traversals file for the current dictionary
+    and traversal rules, e.g. ``traversals-<hash>.json.gz``.
+    """
+    key = json.dumps(
+        [
+            dictionary.checksum(),
+            terminal_nodes,
+            CATEGORY_LEVEL,
+            app.config.get("TRAVERSAL_MAX_PATH_LENGTH"),
+            app.config.get("TRAVERSAL_SHORTEST_K"),
+        ],
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return "traversals-{}.json.gz".format(digest)
+
+
+def save_graph_traversals(graph_traversals, traversals_file):
+    """Write the graph traversal dict to a gzipped JSON file"""
+    os.makedirs(os.path.dirname(os.path.abspath(traversals_file)), exist_ok=True)
+    # write to a temporary file first so the file is never read partially
+    tmp_file = "{}.{}.tmp".format(traversals_file, os.getpid())
+    content = {
+        src_label: {dst_label: sorted(paths) for dst_label, paths in dsts.items()}
+        for src_label, dsts in graph_traversals.items()
+    }
+    with gzip.open(tmp_file, "wt") as f:
+        json.dump(content, f, sort_keys=True, separators=(",", ":"))
+    os.replace(tmp_file, traversals_file)
+
+
+def load_graph_traversals(traversals_file):
+    """Read a graph traversal dict written by ``save_graph_traversals``"""
+    with gzip.open(traversals_file, "rt") as f:
+        return json.load(f)
+
+
 def _get_paths_from(src, app):
     if isinstance(src, type) and issubclass(src, Node):
         src_label = src.label
@@ -170,41 +288,79 @@ def union_subq_path(q, src_label, dst_label, post_filters=[]):
     return base
 
 
-def subq_paths(q, dst_label, post_filters=None):
-    """Given a query and the label of the destination type, filter the
-    selected entity (in the query) on the criteria that it has a path
-    to at least one node with label :param:`dst_label` that matches
-    any lambda filters in :param:`post_filters` (see psqlgraph.query
-    for details on `subq_path`).
-
-    Because ordering a union results in an exception, this function is
-    a workaround to create a union of all `q.entity()` (the source
-    type) and, instead of returning that, creates a new query which
-    selects from all the entities that that union would have returned.
-    This allows us to create a fresh query with the correct filtering
-    that we can later filter/order/etc. as necessary.
-
-    :param q:
-        PsqlGraph graph query object
-    :param dst_label:
-        The label of the type to which the select must have a pat
-    :param post_filters:
-        A list of functions `f(sq)` that take a sub query `sq` apply
-        sqlalchemy compatible filters
-    :returns:
-        PsqlGraph graph query object that selects for the same type of
-        entity as the original :param:`q`
+def make_path_tree(paths):
+    """Merge the given path strings into a tree of links, so that the paths
+    sharing a prefix share the same branch.
 
+    Each link maps to ``{"end": bool, "links": {...}}``, where ``end`` is
+    True if a path ends after following that link.
+    """
+    tree = {}
+    for path in paths:
+        level = tree
+        links = path.split(".")
+        for i, link in enumerate(links):
+            branch = level.setdefault(link, {"end": False, "links": {}})
+            branch["end"] = branch["end"] or i == len(links) - 1
+            level = branch["links"]
+    return tree
+
+
+def path_tree_clause(q, entity, tree, post_filter=None, correlated=False):
+    """Return a SQL condition on ``entity.node_id`` that is true if the node
+    has at least one of the paths in ``tree`` (see ``make_path_tree``) to a
+    node matching ``post_filter``.
+
+    Each link is a single ``IN`` over its edge table, and the branches
+    under a link are OR'ed in the same subquery, so every table along the
+    shared prefixes appears once. If ``correlated``, each link is an
+    ``EXISTS`` correlated with the previous table instead, which lets
+    Postgres stop at the first matching path of each node.
+    """
+    clauses = []
+    for link, branch in sorted(tree.items()):
+        edge, this_id, next_id, target = q._get_link_details(entity, link)
+        target_clauses = []
+        matches_any = False
+        if branch["end"]:
+            end_q = q.session.query(target)
+            if post_filter is not None:
+                end_q = post_filter(end_q)
+            if end_q.whereclause is None:
+                matches_any = True
+            else:
+                target_clauses.append(end_q.whereclause)
+        if not matches_any and branch["links"]:
+            target_clauses.append(
+                path_tree_clause(q, target, branch["links"], post_filter, correlated)
+            )
+        target_clause = None if matches_any else sa.or_(*target_clauses)
+
+        # the edge's foreign key guarantees the node exists, so the target
+        # table is only needed to filter it
+        if correlated:
+            edges = sa.exists().where(this_id == entity.node_id)
+            if target_clause is not None:
+                edges = edges.where(
+                    sa.exists().where(target.node_id == next_id).where(target_clause)
+                )
+            clauses.append(edges)
+        else:
+            next_ids = sa.select(this_id)
+            if target_clause is not None:
+                target_ids = sa.select(target.node_id).where(target_clause)
+                next_ids = next_ids.where(next_id.in_(target_ids))
+            clauses.append(entity.node_id.in_(next_ids))
+    return sa.or_(*clauses)
+
+
+def paths_clause(q, dst_label, post_filter=None, correlated=False):
+    """Return a SQL condition on the entity of ``q`` that is true if it has
+    a path to a node with label :param:`dst_label` matching
+    :param:`post_filter` (see ``path_tree_clause``).
     """
-
-    post_filters = post_filters or []
-
     paths = get_paths_between(q.entity(), dst_label)
     if not paths:
-        return q.filter(sa.sql.false())
-
-    nodes = flask.current_app.db.nodes(q.entity())
-    subquery_paths = [
-        q.subq_path(path, post_filters).subquery().select() for path in paths
-    ]
-    return nodes.select_entity_from(sa.union_all(*subquery_paths))
+        return sa.sql.false()
+    tree = make_path_tree(paths)
+    return path_tree_clause(q, q.entity(), tree, post_filter, correlated)
@@ -9,10 +9,12 @@ Defines utility functions for GraphQL implementation.
 
 from flask import current_app as capp
 from flask import g as fg
+from flask import has_app_context
 from . import node
 from datamodelutils import models
 
 from graphql.utils.ast_to_dict import ast_to_dict
+import psycopg2.extensions
 import sqlalchemy as sa
 from sqlalchemy.orm import load_only
 
@@ -23,6 +25,11 @@ import psqlgraph
 # )
 
 DEFAULT_LIMIT = 10
+# number of rows fetched at once from the server-side cursors of the node
+# queries (see ``iter_query``)
+FETCH_BATCH_SIZE = 500
+# number of nodes fetched and completed at once when streaming results
+STREAM_BATCH_SIZE = FETCH_BATCH_SIZE
 
 
 def set_session_timeout(session, timeout):
@@ -31,6 +38,35 @@ def set_session_timeout(session, timeout):
     )
 
 
+def is_query_canceled(e):
+    """Whether :param:`e` is raised by a statement canceled by the server,
+    e.g. because it exceeded the session's statement timeout"""
+    return isinstance(getattr(e, "orig", e), psycopg2.extensions.QueryCanceledError)
+
+
+def iter_query(q, batch_size=FETCH_BATCH_SIZE):
+    """
+    Yield the nodes selected by :param:`q`, fetched from a server-side
+    cursor in batches of :param:`batch_size`.
+
+    The session's identity map only holds weak references to the nodes, so
+    the nodes of the previous batches are freed once the caller no longer
+    refers to them.
+
+    A query limited to :param:`batch_size` rows is fetched at once, without
+    the round trips of a server-side cursor.
+    """
+    limit = get_query_limit(q)
+    if limit is not None and limit <= batch_size:
+        return iter(q.all())
+    return iter(q.yield_per(batch_size))
+
+
+def get_query_limit(q):
+    """Return the LIMIT of :param:`q`, or None if not limited"""
+    return getattr(q._limit_clause, "value", None)
+
+
 def get_column_names(entity):
     """Returns an iterable of column names the entity has"""
     if hasattr(entity, "__pg_properties__"):
@@ -58,13 +94,7 @@ def filtered_column_dict(row, info, fields_depend_on_columns=None):
 
 
 def get_active_project_ids():
-    return [
-        "{}-{}".format(project.programs[0].name, project.code)
-        for project in capp.db.nodes(Project)
-        .filter(models.Project._props["state"].astext != "closed")
-        .filter(models.Project._props["state"].astext != "legacy")
-        .all()
-    ]
+    return capp.project_catalog.active_project_ids()
 
 
 def active_project_filter(q):
@@ -186,6 +216,34 @@ def apply_load_only(query, info, fields_depend_on_columns=None):
     return query.options(load_only(*columns))
 
 
+def get_props_columns(entity, info, fields_depend_on_columns=None):
+    """Returns the node id (as ``id``) and the ``_props->'<key>'``
+    expressions of the properties required for query"""
+
+    columns = sorted(get_loaded_columns(entity, info, fields_depend_on_columns))
+
+    return [entity.node_id.label("id")] + [
+        entity._props[column].label(column) for column in columns
+    ]
+
+
+def apply_props_only(query, info, fields_depend_on_columns=None):
+    """Returns optimized q selecting only the node id and the properties
+    required for query, instead of whole nodes with their ``_props`` and
+    ``_sysan`` JSONB documents. The query selects rows instead of nodes
+    (see ``node.load_row``).
+    """
+
+    # if the entity doesn't have a backing table then don't do this
+    # this happens when using the generic node property
+    if not hasattr(query.entity(), "__table__"):
+        return query
+
+    columns = get_props_columns(query.entity(), info, fields_depend_on_columns)
+
+    return query.with_entities(*columns)
+
+
 # The below is lifted from
 # https://gist.github.com/mixxorz/dc36e180d1888629cf33
 
@@ -220,12 +278,30 @@ def collect_fields(node, fragments):
 
 def get_fields(info):
     """A convenience function to call collect_fields with info
+
+    Resolvers call this for every node they load, so the result is
+    memoized for the request, per field AST (which determines the
+    fragments: those of its document). Do not modify it.
+
     Args:
         info (ResolveInfo)
     Returns:
         dict: Returned from collect_fields
     """
 
+    if not has_app_context():
+        return collect_info_fields(info)
+
+    cache = fg.setdefault("collected_fields", {})
+    field_ast = info.field_asts[0]
+    if field_ast not in cache:
+        cache[field_ast] = collect_info_fields(info)
+    return cache[field_ast]
+
+
+def collect_info_fields(info):
+    """Call collect_fields with info, see ``get_fields``"""
+
     fragments = {}
     node = ast_to_dict(info.field_asts[0])
 
@@ -246,9 +322,19 @@ def clean_count(q):
         q (psqlgraph.query.GraphQuery): The current query object.
 
     """
-    query_count = (
+    return q.session.execute(clean_count_statement(q)).scalar()
+
+
+def clean_count_statement(q):
+    """Returns the statement counting the results of this query, see
+    :func:`clean_count`.
+
+    Args:
+        q (psqlgraph.query.GraphQuery): The current query object.
+
+    """
+    return (
         q.options(sa.orm.lazyload("*"))
         .statement.with_only_columns([sa.func.count()])
         .order_by(None)
     )
-    return q.session.execute(query_count).scalar()
@@ -1,2 +1,3 @@
 from .payload import get_variables, jsonify_check_errors, parse_request_json
 from .scheduling import AsyncPool
+from .cache import FileSystemCache, MemoryCache, make_cache
@@ -0,0 +1,203 @@
+"""
+Key/value caches with expiration, used to avoid recomputing the same data
+for every request.
+
+``MemoryCache`` keeps the entries in the current process. ``FileSystemCache``
+keeps them in files of a local directory, so they are shared by all the
+processes (e.g. gunicorn workers) running on the same host. Values must be
+JSON serializable. Both count their hits and misses (see ``stats``).
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 1024
+
+
+class MemoryCache(object):
+    """In-process LRU cache with per-entry expiration."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, default_ttl=None):
+        """
+        Args:
+            max_size (int): maximum number of entries
+            default_ttl (float): seconds before an entry expires (None: never)
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (expiration time, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return cache_stats(self)
+
+
+class FileSystemCache(object):
+    """Cache storing each entry in its own file in a local directory."""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, default_ttl=None):
+        """
+        Args:
+            directory (str): directory to store the entries in
+            max_size (int): maximum number of entries
+            default_ttl (float): seconds before an entry expires (None: never)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def __len__(self):
+        return len(self._files())
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def _files(self):
+        return [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        ]
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            entry = None
+        # the key is stored to rule out hash collisions
+        if entry is not None and entry["key"] == key:
+            if entry["expires"] is None or entry["expires"] > time.time():
+                self.hits += 1
+                return entry["value"]
+            self.delete(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        entry = {
+            "key": key,
+            "expires": None if ttl is None else time.time() + ttl,
+            "value": value,
+        }
+        # write to a temporary file first so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self._prune()
+
+    def _prune(self):
+        """Remove the oldest entries while there are more than ``max_size``"""
+        files = self._files()
+        if len(files) <= self.max_size:
+            return
+        mtimes = {}
+        for path in files:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                pass
+        for path in sorted(mtimes, key=mtimes.get)[: len(mtimes) - self.max_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return cache_stats(self)
+
+
+def cache_stats(cache):
+    """
+    Return the number of entries of a cache, and its hits and misses in this
+    process
+    """
+    lookups = cache.hits + cache.misses
+    return {
+        "size": len(cache),
+        "max_size": cache.max_size,
+        "hits": cache.hits,
+        "misses": cache.misses,
+        "hit_rate": float(cache.hits) / lookups if lookups else None,
+    }
+
+
+def make_cache(config):
+    """
+    Create a cache from a settings dict such as ``AUTHZ_CACHE``:
+
+    - ``TTL``: seconds before entries expire
+    - ``MAX_SIZE``: maximum number of entries
+    - ``DIR``: if set, share the entries between processes through this directory
+    """
+    kwargs = {
+        "max_size": config.get("MAX_SIZE", DEFAULT_MAX_SIZE),
+        "default_ttl": config.get("TTL"),
+    }
+    if config.get("DIR"):
+        return FileSystemCache(config["DIR"], **kwargs)
+    return MemoryCache(**kwargs)
@@ -1,4 +1,6 @@
 from contextlib import contextmanager
+import resource
+import sys
 import time
 from flask import current_app
 
@@ -11,3 +13,61 @@ def log_duration(name="Unnamed action"):
     end_t = time.time()
     msg = "Executed [{}] in {:.2f} ms".format(name, (end_t - start_t) * 1000)
     current_app.logger.info(msg)
+
+
+class StartupProfile(object):
+    """
+    Wall time of the startup phases, and peak resident memory of the process
+    at the end of each phase.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.phases = []
+        self.info = {}
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager timing a startup phase. Nested phases are named
+        after their parents, e.g. ``dictionary_init/import gen3datamodel``.
+        """
+        self._stack.append(name)
+        full_name = "/".join(self._stack)
+        start_t = time.time()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self.phases.append(
+                {
+                    "name": full_name,
+                    "seconds": round(time.time() - start_t, 3),
+                    "peak_rss_mb": get_peak_rss_mb(),
+                }
+            )
+
+    def finish(self, **info):
+        """Mark the end of the startup, with extra ``info`` to report"""
+        self.finished_at = time.time()
+        self.info.update(info)
+
+    def to_dict(self):
+        end_t = self.finished_at or time.time()
+        return dict(
+            self.info,
+            total_seconds=round(end_t - self.started_at, 3),
+            peak_rss_mb=get_peak_rss_mb(),
+            phases=self.phases,
+        )
+
+
+def get_peak_rss_mb():
+    """Return the peak resident memory of this process, in MB"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        peak_rss /= 1024
+    return round(peak_rss / 1024.0, 1)
@@ -81,6 +81,9 @@ def pg_driver_clean(request, pg_driver):
             conn.execute("delete from transaction_snapshots")
             conn.execute("delete from transaction_documents")
             conn.execute("delete from transaction_logs")
+        # the rows were deleted without going through the ORM
+        if hasattr(_app, "project_catalog"):
+            _app.project_catalog.invalidate()
 
     tearDown()  # cleanup potential last test data
     request.addfinalizer(tearDown)
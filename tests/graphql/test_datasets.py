@@ -1,3 +1,8 @@
+import gc
+import weakref
+
+import sqlalchemy as sa
+
 from .test_graphql import post_example_entities_together
 from datamodelutils import models
 
@@ -97,6 +102,61 @@ def test_get_projects_anonymous(
     }
 
 
+def test_public_datasets_use_project_catalog(
+    app, client, submitter, pg_driver_clean, cgci_blgsp, public_dataset_api
+):
+    """
+    The list of projects comes from the in-memory catalog, which is
+    refreshed when a project is added
+    """
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    r = client.get("/datasets?nodes=case")
+    assert list(r.json.keys()) == ["CGCI-BLGSP"]
+
+    with pg_driver_clean.session_scope() as s:
+        project = models.Project("other", code="OTHER")
+        program = pg_driver_clean.nodes(models.Program).props(name="CGCI").first()
+        project.programs = [program]
+        s.add(project)
+    r = client.get("/datasets?nodes=case")
+    assert sorted(r.json.keys()) == ["CGCI-BLGSP", "CGCI-OTHER"]
+
+    # the catalog is up to date: projects are not queried again
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(app.db.engine, "before_cursor_execute", record)
+    try:
+        r = client.get("/datasets?nodes=case")
+    finally:
+        sa.event.remove(app.db.engine, "before_cursor_execute", record)
+    assert sorted(r.json.keys()) == ["CGCI-BLGSP", "CGCI-OTHER"]
+    assert not any("node_project" in statement for statement in statements)
+
+
+def test_project_catalog_invalidation(pg_driver_clean, cgci_blgsp):
+    """
+    Writing a project invalidates the catalogs of this process, which the
+    session listeners shared by all the catalogs do not keep alive
+    """
+    from peregrine.catalog import ProjectCatalog
+
+    catalogs = [ProjectCatalog(pg_driver_clean) for _ in range(2)]
+    for catalog in catalogs:
+        catalog.load()
+    with pg_driver_clean.session_scope():
+        project = pg_driver_clean.nodes(models.Project).first()
+        project.state = "closed" if project.state != "closed" else "open"
+    assert all(catalog._loaded_at is None for catalog in catalogs)
+
+    catalog = weakref.ref(catalogs[0])
+    del catalogs
+    gc.collect()
+    assert catalog() is None
+
+
 def test_no_nodes_parameter(client, submitter):
     """
     The endpoint should require the `nodes` query parameter
@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
+import gzip
 import json
 import os
 import random
 import uuid
 
 import pytest
+import sqlalchemy as sa
 from flask import g
 from datamodelutils import models
-from psqlgraph import Node
+from psqlgraph import Edge, Node
 from peregrine import dictionary
 
 from tests.graphql import utils
@@ -215,6 +217,113 @@ def test_quicksearch(client, submitter, pg_driver_clean, cgci_blgsp):
     }
 
 
+def test_quicksearch_trigram_indexes(client, submitter, pg_driver_clean, cgci_blgsp):
+    """quick_search matches the phrase literally and can use the trigram
+    indexes once they are created"""
+    from peregrine.resources.submission.graphql import node, quicksearch
+
+    with pg_driver_clean.engine.connect() as conn:
+        if not conn.execute(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+        ).first():
+            pytest.skip("the pg_trgm extension is not available")
+
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    query = json.dumps(
+        {
+            "query": """{
+      a: node (quick_search: "71-06", first: 0) { id }
+      b: aliquot (quick_search: "blgsp-71") { id submitter_id }
+      c: aliquot (quick_search: "%") { id }
+    }"""
+        }
+    )
+    r = client.post(path, headers=submitter, data=query)
+    assert r.status_code == 200, r.data
+    assert r.json["data"]["a"] and r.json["data"]["b"]
+    assert r.json["data"]["c"] == []
+
+    quicksearch.create_indexes(pg_driver_clean.engine, concurrently=False)
+    try:
+        assert client.post(path, headers=submitter, data=query).json == r.json
+
+        with pg_driver_clean.session_scope() as session:
+            q = node.apply_arg_quicksearch(
+                pg_driver_clean.nodes(models.Aliquot), {"quick_search": "71-06"}, None
+            )
+            statement = q.statement.compile(dialect=session.bind.dialect)
+            conn = session.connection()
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            plan = "\n".join(
+                row[0]
+                for row in conn.exec_driver_sql(
+                    "EXPLAIN " + statement.string, statement.params
+                )
+            )
+        assert quicksearch.get_index_name("node_aliquot", "submitter_id") in plan
+    finally:
+        quicksearch.drop_indexes(pg_driver_clean.engine)
+
+
+def test_quicksearch_of_type_order(client, submitter, pg_driver_clean, cgci_blgsp):
+    """The nodes of several types found by quick_search are ordered by the
+    length of their submitter id before the result is truncated"""
+    with pg_driver_clean.session_scope() as s:
+        s.merge(
+            models.Case("a_case", submitter_id="match_long", project_id="CGCI-BLGSP")
+        )
+        s.merge(
+            models.Sample("b_sample", submitter_id="match", project_id="CGCI-BLGSP")
+        )
+    r = client.post(
+        path,
+        headers=submitter,
+        data=json.dumps(
+            {
+                "query": """{
+        node (of_type: ["case", "sample"], quick_search: "match", first: 1) { id }
+        }"""
+            }
+        ),
+    )
+    assert r.json == {"data": {"node": [{"id": "b_sample"}]}}, r.data
+
+
+def test_quicksearch_order_with_links_any(
+    client, submitter, pg_driver_clean, cgci_blgsp
+):
+    """The length order of quick_search is kept when the query is rebuilt by
+    other arguments, and replaced by the requested order"""
+    with pg_driver_clean.session_scope() as s:
+        for node_id, submitter_id in [("a_case", "match_long"), ("b_case", "match")]:
+            case = models.Case(
+                node_id, submitter_id=submitter_id, project_id="CGCI-BLGSP"
+            )
+            case.samples = [
+                models.Sample(
+                    node_id + "_sample",
+                    submitter_id=submitter_id + "_sample",
+                    project_id="CGCI-BLGSP",
+                )
+            ]
+            s.merge(case)
+    r = client.post(
+        path,
+        headers=submitter,
+        data=json.dumps(
+            {
+                "query": """{
+        a: case (quick_search: "match", with_links_any: ["samples"], first: 1) { id }
+        b: case (quick_search: "match", first: 1, order_by_desc: "submitter_id") { id }
+        }"""
+            }
+        ),
+    )
+    assert r.json == {
+        "data": {"a": [{"id": "b_case"}], "b": [{"id": "a_case"}]}
+    }, r.data
+
+
 def test_quicksearch_skip_empty(client, submitter, pg_driver_clean, cgci_blgsp):
     from peregrine.resources.submission.graphql import node
 
@@ -285,6 +394,34 @@ def test_node_interface_of_type(client, submitter, pg_driver_clean, cgci_blgsp):
     assert not {"case"}.symmetric_difference(types)
 
 
+def test_node_interface_of_type_single_statement(
+    app, client, submitter, pg_driver_clean, cgci_blgsp
+):
+    """Ordering, first and offset apply to the nodes of all the types at
+    once, in a single statement"""
+    put_cases_with_samples(pg_driver_clean, 2, 2)
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """query Test {
+        node (of_type: ["case", "sample"], order_by_desc: "id", first: 3, offset: 1) {
+          id type
+        }}""",
+    )
+
+    assert r.json == {
+        "data": {
+            "node": [
+                {"id": "sample1_0", "type": "sample"},
+                {"id": "sample0_1", "type": "sample"},
+                {"id": "sample0_0", "type": "sample"},
+            ]
+        }
+    }, r.data
+    assert len([s for s in statements if s.lstrip().startswith("SELECT")]) == 1
+
+
 def test_node_interface_category(client, submitter, pg_driver_clean, cgci_blgsp):
     post_example_entities_together(client, pg_driver_clean, submitter)
 
@@ -448,6 +585,169 @@ def test_arg_offset(client, submitter, pg_driver_clean, cgci_blgsp):
     assert not offset.intersection(first)
 
 
+def test_arg_after(client, submitter, pg_driver_clean, cgci_blgsp):
+    """Paging with the cursors of _case_page_info returns the same cases
+    as a single query"""
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    query = """query Test ($after: String) {
+      case (first: 2, order_by_desc: "submitter_id", after: $after) { id }
+      _case_page_info (first: 2, order_by_desc: "submitter_id", after: $after) {
+        end_cursor
+        has_next_page
+      }
+    }"""
+    r = client.post(
+        path,
+        headers=submitter,
+        data=json.dumps(
+            {"query": """{ case (first: 0, order_by_desc: "submitter_id") { id }}"""}
+        ),
+    )
+    expected = [c["id"] for c in r.json["data"]["case"]]
+    assert len(expected) > 2, r.data
+
+    paged = []
+    after = None
+    for _ in expected:
+        r = client.post(
+            path,
+            headers=submitter,
+            data=json.dumps({"query": query, "variables": {"after": after}}),
+        )
+        paged += [c["id"] for c in r.json["data"]["case"]]
+        page_info = r.json["data"]["_case_page_info"]
+        if not page_info["has_next_page"]:
+            break
+        after = page_info["end_cursor"]
+    assert paged == expected
+
+    r = client.post(
+        path,
+        headers=submitter,
+        data=json.dumps({"query": """{ case (after: "not a cursor") { id }}"""}),
+    )
+    assert "Invalid cursor" in r.json["errors"][0], r.data
+
+
+def test_page_info_single_query(app, client, submitter, pg_driver_clean, cgci_blgsp):
+    """The page and its page info are fetched by one query, and the query
+    of a page without page info keeps its order"""
+    put_cases_with_samples(pg_driver_clean, 3, 0)
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """query Test {
+        case (first: 2, order_by_asc: "submitter_id") { id }
+        _case_page_info (first: 2, order_by_asc: "submitter_id") {
+          end_cursor
+          has_next_page
+        }}""",
+    )
+    assert [c["id"] for c in r.json["data"]["case"]] == ["case0", "case1"], r.data
+    assert r.json["data"]["_case_page_info"]["has_next_page"] is True
+    assert len([s for s in statements if "node_case" in s]) == 1
+
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """{ case (first: 2, order_by_asc: "submitter_id") { id }}""",
+    )
+    (statement,) = [s for s in statements if "node_case" in s]
+    assert "node_case.node_id ASC" not in statement
+
+
+def test_graphql_stream(client, submitter, pg_driver_clean, cgci_blgsp):
+    """Streamed results (one JSON line per node) match the JSON response"""
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    query = """{
+      case (first: 0, order_by_asc: "submitter_id") { id samples { id } }
+      _case_count
+    }"""
+    r = client.post(path, headers=submitter, data=json.dumps({"query": query}))
+    expected = r.json["data"]
+
+    headers = dict(submitter, Accept="application/x-ndjson")
+    r = client.post(path, headers=headers, data=json.dumps({"query": query}))
+    assert r.status_code == 200, r.data
+    assert r.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in r.data.decode().splitlines()]
+    assert [line["case"] for line in lines if "case" in line] == expected["case"]
+    assert {"_case_count": expected["_case_count"]} in lines
+    assert not any("errors" in line for line in lines), r.data
+
+    r = client.post(
+        path + "?stream=true",
+        headers=submitter,
+        data=json.dumps({"query": """{ case (order_by_asc: "nope") { id }}"""}),
+    )
+    lines = [json.loads(line) for line in r.data.decode().splitlines()]
+    assert "Cannot order by nope" in lines[-1]["errors"][0], r.data
+
+
+def test_graphql_stream_cached_document(
+    client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch
+):
+    """Streamed queries use the documents cached by the GraphQL backend"""
+    from peregrine.resources.submission.graphql import backend
+
+    validate = backend.validate
+    validated = []
+
+    def record_validate(schema, document_ast):
+        validated.append(document_ast)
+        return validate(schema, document_ast)
+
+    monkeypatch.setattr(backend, "validate", record_validate)
+    headers = dict(submitter, Accept="application/x-ndjson")
+    query = json.dumps({"query": "{ case (first: 0) { id } }"})
+    for _ in range(2):
+        r = client.post(path, headers=headers, data=query)
+        assert r.status_code == 200, r.data
+    assert len(validated) == 1
+
+    r = client.post(
+        path, headers=headers, data=json.dumps({"query": "{ case { nope } }"})
+    )
+    assert r.status_code == 400
+    assert 'Cannot query field "nope"' in r.json["errors"][0]
+
+
+def test_iter_query(client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch):
+    """Nodes are fetched in batches, and the nodes loaded in the session
+    before stay attached to it"""
+    from peregrine.resources.submission.graphql.util import iter_query
+
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    with pg_driver_clean.session_scope() as session:
+        q = pg_driver_clean.nodes().order_by(Node.node_id)
+        loaded = q.all()
+        expected = [n.node_id for n in loaded]
+        assert len(expected) > 2
+
+        ids = [n.node_id for n in iter_query(q, batch_size=2)]
+        assert ids == expected
+        assert all(n in session for n in loaded)
+        assert [n.label for n in loaded]
+
+        # a query limited to a batch is fetched without a cursor
+        yield_per = type(q).yield_per
+        batch_sizes = []
+
+        def record_yield_per(self, count):
+            batch_sizes.append(count)
+            return yield_per(self, count)
+
+        monkeypatch.setattr(type(q), "yield_per", record_yield_per)
+        ids = [n.node_id for n in iter_query(q.limit(2), batch_size=2)]
+        assert ids == expected[:2]
+        assert batch_sizes == []
+        ids = [n.node_id for n in iter_query(q.limit(3), batch_size=2)]
+        assert ids == expected[:3]
+        assert batch_sizes == [2]
+
+
 @pytest.mark.skip(reason="must rewrite query")
 def test_with_path(client, submitter, pg_driver_clean, cgci_blgsp):
     post_example_entities_together(client, pg_driver_clean, submitter)
@@ -755,6 +1055,250 @@ def test_auth_node_subclass_links(client, submitter, pg_driver_clean, cgci_blgsp
             assert case["_samples_count"] == 0, r.data
 
 
+def put_cases_with_samples(pg_driver, n_cases, n_samples):
+    with pg_driver.session_scope() as s:
+        for i in range(n_cases):
+            case = models.Case(
+                "case{}".format(i),
+                submitter_id="c{}".format(i),
+                project_id="CGCI-BLGSP",
+            )
+            case.samples = [
+                models.Sample(
+                    "sample{}_{}".format(i, j),
+                    submitter_id="s{}_{}".format(i, j),
+                    project_id="CGCI-BLGSP",
+                )
+                for j in range(n_samples)
+            ]
+            s.merge(case)
+
+
+def post_query_recording_statements(app, client, submitter, query):
+    """Run a graphql query, returning the response and the SQL statements
+    it executed"""
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(app.db.engine, "before_cursor_execute", record_statement)
+    try:
+        r = client.post(path, headers=submitter, data=json.dumps({"query": query}))
+    finally:
+        sa.event.remove(app.db.engine, "before_cursor_execute", record_statement)
+    return r, statements
+
+
+def test_nested_links_batched(app, client, submitter, pg_driver_clean, cgci_blgsp):
+    n_cases = 4
+    put_cases_with_samples(pg_driver_clean, n_cases, 3)
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """query Test {
+        case (order_by_asc: "id") {
+          id samples (first: 2, offset: 1, order_by_desc: "id") { id }
+        }}""",
+    )
+
+    assert r.json == {
+        "data": {
+            "case": [
+                {
+                    "id": "case{}".format(i),
+                    "samples": [
+                        {"id": "sample{}_1".format(i)},
+                        {"id": "sample{}_0".format(i)},
+                    ],
+                }
+                for i in range(n_cases)
+            ]
+        }
+    }, r.data
+    # the samples of all the cases are fetched in a single query
+    assert len([s for s in statements if "node_sample" in s]) == 1
+
+
+def test_link_counts_batched(app, client, submitter, pg_driver_clean, cgci_blgsp):
+    n_cases = 4
+    put_cases_with_samples(pg_driver_clean, n_cases, 3)
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """query Test {
+        case (order_by_asc: "id") {
+          id _samples_count a: _samples_count (submitter_id: "s1_2")
+        }}""",
+    )
+
+    assert r.json == {
+        "data": {
+            "case": [
+                {"id": "case{}".format(i), "_samples_count": 3, "a": int(i == 1)}
+                for i in range(n_cases)
+            ]
+        }
+    }, r.data
+    # one grouped count query per set of arguments
+    assert len([s for s in statements if "GROUP BY" in s]) == 2
+
+
+def test_props_projection(app, client, submitter, pg_driver_clean, cgci_blgsp):
+    """Only the requested properties are selected, and aliases of a link
+    requesting different properties each get theirs"""
+    put_cases_with_samples(pg_driver_clean, 2, 2)
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """query Test {
+        case (order_by_asc: "id") {
+          submitter_id
+          a: samples (order_by_asc: "id") { id }
+          b: samples (order_by_asc: "id") { submitter_id }
+        }}""",
+    )
+
+    assert r.json == {
+        "data": {
+            "case": [
+                {
+                    "submitter_id": "c{}".format(i),
+                    "a": [{"id": "sample{}_{}".format(i, j)} for j in range(2)],
+                    "b": [{"submitter_id": "s{}_{}".format(i, j)} for j in range(2)],
+                }
+                for i in range(2)
+            ]
+        }
+    }, r.data
+    selects = [s for s in statements if s.lstrip().startswith("SELECT")]
+    assert selects
+    for statement in selects:
+        # whole nodes would include the system annotations
+        assert "_sysan" not in statement.split("FROM")[0], statement
+
+
+def test_get_fields_memoized(app):
+    """The fields of a field AST are collected once per request"""
+    from types import SimpleNamespace
+
+    from graphql.language.parser import parse
+
+    from peregrine.resources.submission.graphql.util import get_fields
+
+    document = parse(
+        """fragment f on case { submitter_id }
+        query Test { case { id ...f } sample { id } }"""
+    )
+    fragments = {"f": document.definitions[0]}
+    case, sample = document.definitions[1].selection_set.selections
+    case_info = SimpleNamespace(field_asts=[case], fragments=fragments)
+    sample_info = SimpleNamespace(field_asts=[sample], fragments=fragments)
+
+    with app.app_context():
+        fields = get_fields(case_info)
+        assert fields == {"id": {}, "submitter_id": {}}
+        assert get_fields(case_info) is fields
+        assert get_fields(sample_info) == {"id": {}}
+    with app.app_context():
+        assert get_fields(case_info) is not fields
+
+
+def test_counts_single_statement(app, client, submitter, pg_driver_clean, cgci_blgsp):
+    put_cases_with_samples(pg_driver_clean, 4, 3)
+    r, statements = post_query_recording_statements(
+        app,
+        client,
+        submitter,
+        """query Test {
+        a: _case_count (project_id: "CGCI-BLGSP")
+        b: _case_count
+        c: _sample_count (submitter_id: ["s1_2", "s2_2"])
+        d: _sample_count (with_path_to: {type: "case", submitter_id: "c3"})
+        e: _project_count (project_id: "CGCI-BLGSP")
+        }""",
+    )
+
+    assert r.json == {"data": {"a": 4, "b": 4, "c": 2, "d": 3, "e": 1}}, r.data
+    assert len([s for s in statements if "count(" in s]) == 1
+
+
+def test_counts_error_on_failing_field_only(
+    client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch
+):
+    """A count failing in the database only fails its own field, not the
+    other counts of the combined statement"""
+    from peregrine.resources.submission.graphql import node
+
+    put_cases_with_samples(pg_driver_clean, 4, 3)
+    get_count_query = node.get_count_query
+
+    def get_failing_count_query(cls, args, info):
+        q = get_count_query(cls, args, info)
+        if cls.label == "sample":
+            q = q.filter(sa.text("1 / 0 = 1"))
+        return q
+
+    monkeypatch.setattr(node, "get_count_query", get_failing_count_query)
+    r = client.post(
+        path,
+        headers=submitter,
+        data=json.dumps(
+            {
+                "query": """query Test {
+        a: _case_count (project_id: "CGCI-BLGSP")
+        b: _sample_count (submitter_id: ["s1_2", "s2_2"])
+        c: _case_count (submitter_id: ["c1"])
+        d: case (first: 1, order_by_asc: "id") { id }
+        }"""
+            }
+        ),
+    )
+    assert r.json["data"] == {"a": 4, "b": None, "c": 1, "d": [{"id": "case0"}]}
+    assert len(r.json["errors"]) == 1 and "division by zero" in r.json["errors"][0]
+
+
+def test_counts_canceled_not_run_one_by_one(
+    client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch
+):
+    """A canceled count statement (e.g. timed out) fails all the counts
+    without running them again one by one"""
+    import psycopg2.extensions
+    from peregrine.resources.submission.graphql import node
+
+    put_cases_with_samples(pg_driver_clean, 2, 1)
+    calls = []
+
+    def execute(session, queries, params, savepoint=False):
+        calls.append(len(queries))
+        raise sa.exc.OperationalError(
+            "SELECT",
+            {},
+            psycopg2.extensions.QueryCanceledError("canceling statement"),
+        )
+
+    monkeypatch.setattr(node.NodeCounter, "execute", staticmethod(execute))
+    r = client.post(
+        path,
+        headers=submitter,
+        data=json.dumps(
+            {
+                "query": """query Test {
+        a: _case_count (project_id: "CGCI-BLGSP")
+        b: _sample_count
+        d: case (first: 1, order_by_asc: "id") { id }
+        }"""
+            }
+        ),
+    )
+    assert r.json["data"] == {"a": None, "b": None, "d": [{"id": "case0"}]}
+    assert len(r.json["errors"]) == 2
+    assert calls == [2]
+
+
 @pytest.mark.skip(reason='"clinicals" is not a link name')
 def test_with_links_any(client, submitter, pg_driver_clean, cgci_blgsp):
     post_example_entities_together(client, pg_driver_clean, submitter)
@@ -867,6 +1411,194 @@ def test_with_path_to(client, submitter, pg_driver_clean, cgci_blgsp):
     assert r.json["data"]["aliquot"] == [{"a": "BLGSP-71-06-00019-01A-11D"}]
 
 
+def test_with_path_to_exists_mode(
+    app, client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch
+):
+    """The EXISTS evaluation of the path filters returns the same results
+    as the default one"""
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    with pg_driver_clean.session_scope():
+        case = pg_driver_clean.nodes(models.Case).path("samples").first()
+        case_id, case_sub_id = case.node_id, case.submitter_id
+    query = """query Test ($caseId: String, $caseSubId: String) {
+      a: aliquot (
+        order_by_asc: "id", with_path_to: {type: "case", submitter_id: $caseSubId}
+      ) { id }
+      b: sample (
+        order_by_asc: "id",
+        with_path_to: [{type: "case", id: $caseId}, {type: "aliquot"}]
+      ) { id }
+      c: sample (order_by_asc: "id", with_path_to_any: [
+        {type: "case", id: $caseId}, {type: "case", submitter_id: "none"}
+      ]) { id }
+      d: sample (order_by_asc: "id", without_path_to: {type: "case", id: $caseId}) {
+        id
+      }
+      e: case (with_path_to: {type: "aliquot"}, first: 1, order_by_asc: "id") {
+        id
+      }
+      f: _case_count (with_path_to_any: [{type: "aliquot"}, {type: "sample"}])
+      g: _aliquot_count (without_path_to: [{type: "case"}, {type: "sample"}])
+      h: read_group (with_path_to: {type: "sample"}, order_by_asc: "id") { id }
+    }"""
+    body = json.dumps(
+        {"query": query, "variables": {"caseId": case_id, "caseSubId": case_sub_id}}
+    )
+
+    r = client.post(path, headers=submitter, data=body)
+    assert r.status_code == 200, r.data
+    assert r.json["data"]["a"] and r.json["data"]["c"]
+
+    monkeypatch.setitem(app.config, "WITH_PATH_TO_MODE", "exists")
+    r_exists = client.post(path, headers=submitter, data=body)
+    assert r_exists.status_code == 200, r_exists.data
+    assert r_exists.json == r.json
+
+
+def test_with_path_to_ancestor_mappings(
+    app, client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch
+):
+    """The path filters use the materialized ancestor mappings when they
+    are built, not stale and their triggers are installed"""
+    from peregrine.resources.submission.graphql import ancestors
+
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    query = json.dumps(
+        {
+            "query": """{
+      a: aliquot (with_path_to: {type: "sample"}, first: 0, order_by_asc: "id") {
+        id
+      }
+      b: _aliquot_count (with_path_to: {type: "sample", sample_type: "none"})
+      c: aliquot (without_path_to: {type: "sample"}) { id }
+    }"""
+        }
+    )
+    r = client.post(path, headers=submitter, data=query)
+    assert r.json["data"]["a"]
+
+    mappings = ancestors.AncestorMappings(pg_driver_clean, refresh_interval=0)
+    monkeypatch.setattr(app, "ancestor_mappings", mappings)
+    ancestors.create_tables(pg_driver_clean.engine)
+    try:
+        assert not mappings.has("aliquot", "sample")
+        assert ancestors.rebuild(pg_driver_clean, "aliquot", "sample", app) == len(
+            r.json["data"]["a"]
+        )
+        assert mappings.has("aliquot", "sample")
+        assert client.post(path, headers=submitter, data=query).json == r.json
+
+        # without the triggers, the mapping could be out of date
+        ((edge, _, _),) = ancestors.get_path_edges("aliquot", "samples")
+        edge_table = edge.__tablename__
+        pg_driver_clean.engine.execute(
+            'ALTER TABLE "{}" DISABLE TRIGGER {}'.format(
+                edge_table, ancestors.STALE_TRIGGER
+            )
+        )
+        assert not mappings.has("aliquot", "sample")
+        pg_driver_clean.engine.execute(
+            'ALTER TABLE "{}" ENABLE TRIGGER {}'.format(
+                edge_table, ancestors.STALE_TRIGGER
+            )
+        )
+        assert mappings.has("aliquot", "sample")
+
+        # changing the edges along the paths marks the mapping as stale, and
+        # the queries traverse the paths again before the pairs are reloaded
+        monkeypatch.setattr(mappings, "refresh_interval", 600)
+        with pg_driver_clean.session_scope():
+            aliquot = pg_driver_clean.nodes(models.Aliquot).first()
+            aliquot_id = aliquot.node_id
+            aliquot.samples = []
+        assert mappings.has("aliquot", "sample")
+        r = client.post(path, headers=submitter, data=query)
+        assert aliquot_id not in [a["id"] for a in r.json["data"]["a"]]
+        assert aliquot_id in [a["id"] for a in r.json["data"]["c"]]
+        mappings.invalidate()
+        assert not mappings.has("aliquot", "sample")
+    finally:
+        ancestors.drop_tables(pg_driver_clean.engine)
+
+
+def test_node_index(app, client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch):
+    """The queries of nodes by id or submitter_id look up their tables in
+    the node index when it is built"""
+    from peregrine.resources.submission.graphql import node_index
+
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    with pg_driver_clean.session_scope():
+        sample = pg_driver_clean.nodes(models.Sample).first()
+        sample_id, submitter_id = sample.node_id, sample.submitter_id
+        node_count = pg_driver_clean.nodes().count()
+
+    def post_query():
+        r = client.post(
+            path,
+            headers=submitter,
+            data=json.dumps(
+                {
+                    "query": """{{
+          a: node (id: "{id}") {{ id type submitter_id }}
+          b: node (submitter_id: "{submitter_id}") {{ id type }}
+          c: sample (id: "{id}") {{ _links {{ id type }} }}
+        }}""".format(
+                        id=sample_id, submitter_id=submitter_id
+                    )
+                }
+            ),
+        )
+        assert r.status_code == 200, r.data
+        data = r.json["data"]
+        data["c"][0]["_links"].sort(key=lambda link: link["id"])
+        return data
+
+    expected = post_query()
+    assert expected["a"] == [
+        {"id": sample_id, "type": "sample", "submitter_id": submitter_id}
+    ]
+    assert expected["c"][0]["_links"]
+
+    index = node_index.NodeIndex(pg_driver_clean, refresh_interval=0)
+    monkeypatch.setattr(app, "node_index", index)
+    node_index.create_tables(pg_driver_clean.engine)
+    try:
+        assert not index.is_ready()
+        assert node_index.rebuild(pg_driver_clean) == node_count
+        assert index.is_ready()
+        assert post_query() == expected
+
+        # the triggers index the new nodes
+        with pg_driver_clean.session_scope() as session:
+            session.add(
+                models.Case(
+                    "indexed_case", submitter_id="indexed_case", project_id="CGCI-BLGSP"
+                )
+            )
+        with pg_driver_clean.session_scope() as session:
+            labels = index.get_labels(session, submitter_ids=["indexed_case"])
+        assert labels == {"case"}
+
+        # not used while a trigger is disabled
+        table = models.Case.__tablename__
+        with pg_driver_clean.engine.begin() as conn:
+            conn.execute(
+                'ALTER TABLE "{}" DISABLE TRIGGER {}'.format(
+                    table, node_index.TRUNCATE_TRIGGER
+                )
+            )
+        assert not index.is_ready()
+        with pg_driver_clean.engine.begin() as conn:
+            conn.execute(
+                'ALTER TABLE "{}" ENABLE TRIGGER {}'.format(
+                    table, node_index.TRUNCATE_TRIGGER
+                )
+            )
+        assert index.is_ready()
+    finally:
+        node_index.drop_tables(pg_driver_clean.engine)
+
+
 def test_variable(client, submitter, pg_driver_clean, cgci_blgsp):
     post_example_entities_together(client, pg_driver_clean, submitter)
     with pg_driver_clean.session_scope():
@@ -1123,6 +1855,335 @@ def test_special_case_project_id(
     }
 
 
+def test_authz_cache(client, submitter, pg_driver_clean, cgci_blgsp, app, monkeypatch):
+    from gen3authz.client.arborist.client import ArboristClient
+    from gen3authz.client.arborist.errors import ArboristError
+
+    from peregrine.resources.submission import invalidate_read_access_projects
+    from peregrine.utils import MemoryCache
+
+    monkeypatch.setattr(app, "authz_cache", MemoryCache(default_ttl=60))
+    data = json.dumps({"query": """{ project { project_id } }"""})
+
+    # the project list is only requested from arborist once
+    for _ in range(2):
+        r = client.post(path, headers=submitter, data=data)
+        assert r.json == {"data": {"project": [{"project_id": "CGCI-BLGSP"}]}}
+    assert ArboristClient.auth_mapping.call_count == 1
+
+    with app.test_request_context():
+        invalidate_read_access_projects()
+    r = client.post(path, headers=submitter, data=data)
+    assert r.json == {"data": {"project": [{"project_id": "CGCI-BLGSP"}]}}
+    assert ArboristClient.auth_mapping.call_count == 2
+
+    # an Arborist error is not cached
+    with app.test_request_context():
+        invalidate_read_access_projects()
+    with monkeypatch.context() as m:
+        m.setattr(
+            ArboristClient.auth_mapping,
+            "side_effect",
+            ArboristError("Arborist is down", 500),
+        )
+        r = client.post(path, headers=submitter, data=data)
+        assert r.json == {"data": {"project": []}}
+    r = client.post(path, headers=submitter, data=data)
+    assert r.json == {"data": {"project": [{"project_id": "CGCI-BLGSP"}]}}
+    assert ArboristClient.auth_mapping.call_count == 4
+
+
+def test_graphql_document_cache(client, submitter, pg_driver_clean, cgci_blgsp, app):
+    cache = app.graphql_backend.cache
+    cache.clear()
+    valid = json.dumps({"query": """{ project { project_id } }"""})
+    invalid = json.dumps({"query": """{ project { not_a_field } }"""})
+
+    for _ in range(2):
+        hits = cache.hits
+        r = client.post(path, headers=submitter, data=valid)
+        assert r.json == {"data": {"project": [{"project_id": "CGCI-BLGSP"}]}}
+        r = client.post(path, headers=submitter, data=invalid)
+        assert r.status_code == 400
+        assert "not_a_field" in r.json["errors"][0]
+    # the second time, both documents came from the cache
+    assert cache.hits == hits + 2
+    assert len(cache) == 2
+
+    r = client.get("/_status/caches")
+    assert r.json["graphql_documents"]["size"] == 2
+
+
+def test_graphql_result_cache(
+    client,
+    submitter,
+    pg_driver_clean,
+    cgci_blgsp,
+    put_tcga_brca,
+    app,
+    monkeypatch,
+    mock_arborist_requests,
+):
+    from peregrine.utils import MemoryCache
+
+    monkeypatch.setattr(app, "graphql_result_cache", MemoryCache(default_ttl=60))
+    put_cases_with_samples(pg_driver_clean, 2, 0)
+    query = "{ _case_count }"
+
+    r, statements = post_query_recording_statements(app, client, submitter, query)
+    assert r.json == {"data": {"_case_count": 2}}
+    assert statements
+
+    # same result, without touching the database
+    r, statements = post_query_recording_statements(
+        app, client, submitter, " {  _case_count } "
+    )
+    assert r.json == {"data": {"_case_count": 2}}
+    assert not statements
+
+    # users with access to other projects do not share the cached result
+    mock_arborist_requests(
+        auth_mapping={
+            "/programs/TCGA/projects/BRCA": [{"service": "peregrine", "method": "read"}]
+        }
+    )
+    r, statements = post_query_recording_statements(app, client, submitter, query)
+    assert r.json == {"data": {"_case_count": 0}}
+    assert statements
+
+
+def test_getschema(client, app, monkeypatch, tmpdir):
+    from peregrine.resources import submission
+
+    schema_file = str(tmpdir.join(submission.get_schema_file_name()))
+    submission.write_schema_file(app.graphql_schema, schema_file)
+    monkeypatch.setattr(app, "schema_file", schema_file)
+    monkeypatch.setattr(app, "schema_etag", submission.get_file_etag(schema_file))
+
+    r = client.get("/v0/submission/getschema")
+    assert r.status_code == 200
+    assert "Content-Encoding" not in r.headers
+    assert len(r.json["data"]["__schema"]["types"]) > 30
+
+    r_gzip = client.get("/v0/submission/getschema", headers={"Accept-Encoding": "gzip"})
+    assert r_gzip.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(r_gzip.data) == r.data
+    assert r_gzip.headers["ETag"] != r.headers["ETag"]
+
+    r = client.get(
+        "/v0/submission/getschema", headers={"If-None-Match": r.headers["ETag"]}
+    )
+    assert r.status_code == 304
+
+
+def test_generate_schema_file(app, monkeypatch, tmpdir):
+    """The schema is written to the locked file, and its file name depends
+    on the dictionary settings"""
+    from peregrine.resources import submission
+
+    monkeypatch.chdir(tmpdir)
+    schema_file = submission.generate_schema_file(app.graphql_schema, app.logger)
+    with open(schema_file, "r") as f:
+        content = f.read()
+    assert json.loads(content)["data"]["__schema"]["types"]
+    with gzip.open(schema_file + ".gz", "rt") as f:
+        assert f.read() == content
+
+    name = submission.get_schema_file_name()
+    settings = dict(dictionary.settings or {})
+    settings["enable_case_cache"] = not settings.get("enable_case_cache")
+    monkeypatch.setattr(dictionary, "settings", settings)
+    assert submission.get_schema_file_name() != name
+
+
+def test_dictionary_load_from_dir_cache(tmpdir):
+    import gdcdictionary
+    from dictionaryutils import DataDictionary
+
+    root_dir = gdcdictionary.gdcdictionary.root_dir
+    expected = DataDictionary(root_dir=root_dir)
+
+    cache_dir = str(tmpdir)
+    for _ in range(2):  # the second time, from the cached bundle
+        d = dictionary.load_from_dir(root_dir, cache_dir)
+        assert d.schema == expected.schema
+        assert d.settings == expected.settings
+        assert len(tmpdir.listdir()) == 1
+
+
+def test_dictionary_load_from_url_cache(monkeypatch, tmpdir):
+    import gdcdictionary
+    import requests
+    from dictionaryutils import DataDictionary, load_schemas_from_dir
+
+    root_dir = gdcdictionary.gdcdictionary.root_dir
+    expected = DataDictionary(root_dir=root_dir)
+    schemas, _ = load_schemas_from_dir(root_dir)
+
+    fetched = []
+
+    def get(url):
+        fetched.append(url)
+        r = requests.Response()
+        r.status_code = 200
+        r._content = json.dumps(schemas).encode("utf-8")
+        return r
+
+    monkeypatch.setattr(requests, "get", get)
+    url = "http://dictionary/schema.json"
+    cache_dir = str(tmpdir)
+    for _ in range(2):  # the second time, from the cached file
+        d = dictionary.load_from_url(url, cache_dir)
+        assert d.schema == expected.schema
+        assert fetched == [url]
+    assert tmpdir.join(
+        "dictionary-{}.json".format(dictionary.get_schema_checksum(d.schema))
+    ).check()
+
+    # fetched again when the cached file is too old
+    d = dictionary.load_from_url(url, cache_dir, max_age=0)
+    assert d.schema == expected.schema
+    assert fetched == [url, url]
+
+
+def test_startup_profile(client):
+    r = client.get("/_status/startup")
+    assert r.status_code == 200
+    phases = {phase["name"]: phase for phase in r.json["phases"]}
+    for name in [
+        "dictionary_init",
+        "db_init",
+        "ancestor_mappings_init",
+        "node_index_init",
+        "get_schema",
+        "graphql_backend_init",
+        "graphql_result_cache_init",
+        "generate_schema_file",
+        "authz_cache_init",
+    ]:
+        assert phases[name]["seconds"] >= 0
+    assert r.json["graphql_types"] > 30
+    assert r.json["total_seconds"] >= phases["get_schema"]["seconds"]
+
+
+def test_graph_traversals_file(app, monkeypatch, tmpdir):
+    from peregrine.resources.submission.graphql import traversal
+
+    monkeypatch.setitem(app.config, "TRAVERSALS_DIR", str(tmpdir))
+
+    # computed and saved
+    monkeypatch.setattr(app, "graph_traversals", {})
+    traversal.make_graph_traversal_dict(app)
+    assert len(tmpdir.listdir()) == 1
+    computed = app.graph_traversals
+
+    # loaded from the file
+    monkeypatch.setattr(app, "graph_traversals", {})
+    traversal.make_graph_traversal_dict(app)
+    assert app.graph_traversals.keys() == computed.keys()
+    for src_label, dsts in computed.items():
+        assert {dst: sorted(paths) for dst, paths in dsts.items()} == {
+            dst: sorted(paths) for dst, paths in app.graph_traversals[src_label].items()
+        }
+    assert traversal.get_paths_between("case", "aliquot", app)
+
+
+def reference_traversals_from_node(root_node):
+    """The original, straightforward path enumeration: copies the path and
+    the visited nodes for each step"""
+    from peregrine.resources.submission.graphql.traversal import (
+        is_valid_direction,
+        terminal_nodes,
+    )
+
+    traversals = {node.label: set() for node in Node.get_subclasses()}
+    name_to_subclass = {n.__name__: n for n in Node.get_subclasses()}
+    to_visit = [(root_node, [], [])]
+    while to_visit:
+        node, path, visited = to_visit.pop()
+        if path:
+            path_string = ".".join(path)
+            if path_string in traversals[node.label]:
+                continue
+            traversals[node.label].add(path_string)
+            if path[-1] in terminal_nodes:
+                continue
+        if not is_valid_direction(node, visited or [root_node]):
+            continue
+        neighbors = {
+            (name_to_subclass[edge.__dst_class__], edge.__src_dst_assoc__)
+            for edge in Edge._get_edges_with_src(node.__name__)
+        } | {
+            (name_to_subclass[edge.__src_class__], edge.__dst_src_assoc__)
+            for edge in Edge._get_edges_with_dst(node.__name__)
+        }
+        to_visit.extend(
+            (neighbor, path + [edge], visited + [node])
+            for neighbor, edge in neighbors
+            if neighbor not in visited
+        )
+    return {label: paths for label, paths in traversals.items() if paths}
+
+
+def test_construct_traversals(app, monkeypatch):
+    from peregrine.resources.submission.graphql.traversal import (
+        construct_traversals_from_node,
+    )
+
+    for node in Node.get_subclasses():
+        traversals = construct_traversals_from_node(node, app)
+        assert {label: set(paths) for label, paths in traversals.items()} == (
+            reference_traversals_from_node(node)
+        )
+
+    monkeypatch.setitem(app.config, "TRAVERSAL_MAX_PATH_LENGTH", 2)
+    traversals = construct_traversals_from_node(models.Case, app)
+    assert traversals["aliquot"] == ["samples.aliquots"]
+    assert all(p.count(".") < 2 for paths in traversals.values() for p in paths)
+
+    monkeypatch.setitem(app.config, "TRAVERSAL_MAX_PATH_LENGTH", None)
+    monkeypatch.setitem(app.config, "TRAVERSAL_SHORTEST_K", 1)
+    traversals = construct_traversals_from_node(models.Case, app)
+    assert all(len(paths) == 1 for paths in traversals.values())
+    assert traversals["aliquot"] == ["samples.aliquots"]
+
+
+def test_paths_clause_merges_paths(app, client, submitter, pg_driver_clean, cgci_blgsp):
+    """The merged path tree selects the same nodes as the union of one
+    subquery per path, with each node once"""
+    from peregrine.resources.submission.graphql.traversal import (
+        get_paths_between,
+        make_path_tree,
+        paths_clause,
+    )
+
+    assert make_path_tree(["a.b", "a.c", "a", "d"]) == {
+        "a": {
+            "end": True,
+            "links": {
+                "b": {"end": True, "links": {}},
+                "c": {"end": True, "links": {}},
+            },
+        },
+        "d": {"end": True, "links": {}},
+    }
+
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    labels = ["case", "sample", "aliquot", "analyte", "portion", "project"]
+    with app.app_context(), pg_driver_clean.session_scope():
+        for src in labels:
+            for dst in labels:
+                paths = get_paths_between(src, dst, app)
+                if src == dst or not paths:
+                    continue
+                q = pg_driver_clean.nodes(Node.get_subclass(src))
+                expected = set()
+                for path in paths:
+                    expected |= {n.node_id for n in q.subq_path(path).all()}
+                node_ids = [n.node_id for n in q.filter(paths_clause(q, dst)).all()]
+                assert sorted(node_ids) == sorted(expected), (src, dst)
+
+
 def test_catch_language_error(client, submitter, pg_driver_clean, cgci_blgsp):
     post_example_entities_together(client, pg_driver_clean, submitter)
     r = client.post(
@@ -1142,6 +2203,52 @@ def test_catch_language_error(client, submitter, pg_driver_clean, cgci_blgsp):
     }
 
 
+def test_list_filter_containment(client, submitter, pg_driver_clean, cgci_blgsp):
+    """The list property filters (JSONB containment) select the same nodes
+    as the superset test of the lists, and as the substring match of the
+    quoted values in the JSON text of the lists they replace"""
+    from peregrine.resources.submission.graphql import node
+
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    checked = 0
+    with pg_driver_clean.session_scope():
+        for cls in Node.get_subclasses():
+            for key, types in cls.__pg_properties__.items():
+                if types[0] != list:
+                    continue
+                lists = {
+                    n.node_id: n._props.get(key) or []
+                    for n in pg_driver_clean.nodes(cls).all()
+                }
+                items = sorted(
+                    {
+                        v
+                        for values in lists.values()
+                        for v in values
+                        if isinstance(v, str)
+                    }
+                )
+                filters = [[v] for v in items] + [items[:2], ["no_such_value"]]
+                # substrings of the values
+                filters += [[v[1:]] for v in items] + [[v[:-1]] for v in items]
+                for values in filters:
+                    q = node.apply_query_args(
+                        pg_driver_clean.nodes(cls), {key: values, "first": 0}, None
+                    )
+                    like_q = pg_driver_clean.nodes(cls).filter(
+                        *[cls._props[key].astext.like('%"' + v + '"%') for v in values]
+                    )
+                    expected = {
+                        node_id
+                        for node_id, node_values in lists.items()
+                        if set(values).issubset(node_values)
+                    }
+                    assert {n.node_id for n in q} == expected, (cls.label, values)
+                    assert {n.node_id for n in like_q} == expected, (cls.label, values)
+                    checked += 1
+    assert checked
+
+
 @pytest.mark.skip(reason="must rewrite query")
 def test_filter_empty_prop_list(
     client, submitter, pg_driver_clean, cgci_blgsp, monkeypatch
@@ -1662,7 +2769,6 @@ def test_datanode_query_all(
     """
     Regression test for a bug where querying all datanode objects does not return all objects
     because "limit" and "offset" are not applied correctly.
-    Mitigated by datanode returning the first <limit> items for each file node.
     """
     post_example_entities_together(client, pg_driver_clean, submitter)
     utils.put_entity_from_file(client, "read_group.json", submitter)
@@ -1714,8 +2820,8 @@ def test_datanode_query_all(
         data = resp.get("data", {}).get("datanode", [])
         if not len(data):
             break
-        # "chunk_size * 2" because datanode returns the first <limit> items for each file node
-        assert len(data) <= chunk_size * 2
+        # "limit" and "offset" apply to the items of all the file nodes at once
+        assert len(data) <= chunk_size
         results = results + data
         offset += chunk_size
     check_results(results)
@@ -1727,6 +2833,39 @@ def test_datanode_query_all(
     check_results(results)
 
 
+def test_datanode_order_across_types(
+    graphql_client, client, submitter, pg_driver_clean, cgci_blgsp
+):
+    """Ordering, first and offset apply to the items of all the file nodes"""
+    post_example_entities_together(client, pg_driver_clean, submitter)
+    utils.put_entity_from_file(client, "read_group.json", submitter)
+
+    with pg_driver_clean.session_scope() as s:
+        rg = pg_driver_clean.nodes(models.ReadGroup).one()
+        rg.submitted_unaligned_reads_files = [
+            models.SubmittedUnalignedReads(
+                "sur_{}".format(i), project_id="CGCI-BLGSP", file_size=i
+            )
+            for i in range(0, 10, 2)
+        ]
+        rg.submitted_aligned_reads_files = [
+            models.SubmittedAlignedReads(
+                "sar_{}".format(i), project_id="CGCI-BLGSP", file_size=i
+            )
+            for i in range(1, 10, 2)
+        ]
+        s.merge(rg)
+
+    query_txt = '{datanode (first: 4, offset: 1, order_by_desc: "file_size") {id}}'
+    resp = graphql_client(query_txt).json
+    assert [e["id"] for e in resp["data"]["datanode"]] == [
+        "sur_8",
+        "sar_7",
+        "sur_6",
+        "sar_5",
+    ], resp
+
+
 def test_boolean_filter(client, submitter, pg_driver_clean, cgci_blgsp):
     post_example_entities_together(client, pg_driver_clean, submitter)
 